@@ -0,0 +1,127 @@
+"""A fake ForcAD checksystem, used to benchmark the farm without a real game."""
+
+import json
+import random
+
+from hashlib import sha256
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeForcAD(object):
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0.0,
+        rate_limit: float = 0.0,
+        accept_ratio: float = 0.8,
+        attack_data: dict | None = None,
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.accept_ratio = accept_ratio
+        self.attack_data = attack_data or {}
+        self.lock = Lock()
+        # flag -> (time of the submission, accepted)
+        self.received: dict[str, tuple[float, bool]] = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self._tokens = rate_limit
+        self._last_refill = perf_counter()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def start(self) -> None:
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+    def _take_token(self) -> bool:
+        if self.rate_limit <= 0:
+            return True
+        with self.lock:
+            now = perf_counter()
+            self._tokens = min(
+                self.rate_limit,
+                self._tokens + (now - self._last_refill) * self.rate_limit,
+            )
+            self._last_refill = now
+            if self._tokens < 1:
+                self.rate_limited += 1
+                return False
+            self._tokens -= 1
+            return True
+
+    def _judge(self, flag: str) -> dict[str, str]:
+        # Hash the flag, so that resubmissions always get the same answer
+        digest = sha256(flag.encode()).digest()
+        accepted = digest[0] / 256 < self.accept_ratio
+        with self.lock:
+            if flag in self.received:
+                return {"flag": flag, "status": "RESUBMIT", "msg": f"[{flag}] Resubmit"}
+            self.received[flag] = (perf_counter(), accepted)
+        if accepted:
+            return {"flag": flag, "status": "ACCEPTED", "msg": f"[{flag}] Accepted"}
+        return {
+            "flag": flag,
+            "status": "DENIED",
+            "msg": f"[{flag}] Denied: no such flag",
+        }
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, body: object) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_PUT(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                with fake.lock:
+                    fake.requests += 1
+                if not fake._take_token():
+                    self._reply(429, {"error": "rate limited"})
+                    return
+                if fake.latency > 0:
+                    sleep(fake.latency * random.uniform(0.5, 1.5))
+                try:
+                    submitted = json.loads(body)
+                except ValueError:
+                    self._reply(400, {"error": "invalid json"})
+                    return
+                self._reply(200, [fake._judge(str(x)) for x in submitted])
+
+            def do_GET(self) -> None:
+                if self.path.startswith("/api/client/attack_data"):
+                    self._reply(200, fake.attack_data)
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--accept-ratio", type=float, default=0.8)
+    args = parser.parse_args()
+    fake = FakeForcAD(args.port, args.latency, args.rate_limit, args.accept_ratio)
+    print(f"Fake ForcAD listening on {fake.url}/flags")
+    fake._server.serve_forever()
@@ -0,0 +1,327 @@
+"""End-to-end benchmark of the farm.
+
+Boots server/main.py against a temporary database and a fake ForcAD checksystem,
+pushes flags from simulated start_sploit clients at a controlled rate and reports
+how fast the farm ingests and submits them.
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import socket
+import string
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import requests
+
+from threading import Thread
+from time import perf_counter, sleep, time
+from fake_forcad import FakeForcAD
+
+
+_SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+_PASSWORD = "bench"
+_FLAG_ALPHABET = string.ascii_uppercase + string.digits
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def random_flag() -> str:
+    return "".join(random.choices(_FLAG_ALPHABET, k=31)) + "="
+
+
+class Client(object):
+    """A simulated start_sploit, pushing batches of flags for a single exploit."""
+
+    def __init__(self, url: str, exploit: str, rate: float, batch: int):
+        self.url = url
+        self.exploit = exploit
+        self.period = batch / rate
+        self.batch = batch
+        self.latencies: list[float] = []
+        self.sent: dict[str, float] = {}
+        self.errors = 0
+        self.session = requests.Session()
+        self.session.post(f"{url}/api/auth", json={"password": _PASSWORD})
+
+    def run(self, duration: float) -> None:
+        start = perf_counter()
+        next_batch = start
+        while (now := perf_counter()) - start < duration:
+            if next_batch > now:
+                sleep(next_batch - now)
+            next_batch += self.period
+            flags = [random_flag() for _ in range(self.batch)]
+            payload = [{"flag": x, "ts": int(time()), "team": "bench"} for x in flags]
+            t0 = perf_counter()
+            try:
+                response = self.session.post(
+                    f"{self.url}/api/flags/{self.exploit}", json=payload, timeout=30
+                )
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            t1 = perf_counter()
+            self.latencies.append(t1 - t0)
+            if ok:
+                self.sent.update((x, t1) for x in flags)
+            else:
+                self.errors += 1
+
+
+def wait_for_server(url: str, process: subprocess.Popen, timeout: float) -> None:
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited during startup")
+        try:
+            requests.get(f"{url}/auth", timeout=1)
+            return
+        except requests.RequestException:
+            sleep(0.1)
+    raise RuntimeError("The server did not start in time")
+
+
+def count_statuses(url: str) -> dict[str, int]:
+    # Ask the server, it works with every flag store
+    try:
+        response = requests.get(f"{url}/metrics", auth=("", _PASSWORD), timeout=10)
+    except requests.RequestException:
+        return {}
+    statuses = {}
+    for line in response.text.splitlines():
+        if line.startswith('farm_flags{status="'):
+            labels, _, value = line.partition(" ")
+            statuses[labels.split('"')[1]] = int(float(value))
+    return statuses
+
+
+def measure_storage(database: str) -> dict | None:
+    # Only the SQLite flag store keeps the flags in the database
+    connection = sqlite3.connect(database)
+    try:
+        # Move the WAL back into the database, so that only the database is measured
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        used = (
+            connection.execute("PRAGMA page_count").fetchone()[0]
+            - connection.execute("PRAGMA freelist_count").fetchone()[0]
+        ) * connection.execute("PRAGMA page_size").fetchone()[0]
+        flags = connection.execute("SELECT count(*) FROM flags").fetchone()[0]
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+    return {
+        "bytes": used,
+        "flags": flags,
+        "bytesPerFlag": used / flags if flags else None,
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix="farm-bench-")
+    database = os.path.join(workdir, "flags.db")
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+
+    fake = FakeForcAD(
+        latency=args.system_latency,
+        rate_limit=args.system_rate_limit,
+        accept_ratio=args.accept_ratio,
+    )
+    fake.start()
+
+    env = {
+        **os.environ,
+        "FARM_PORT": str(port),
+        "FARM_ADDRESS": "127.0.0.1",
+        "FARM_PASSWORD": _PASSWORD,
+        "FARM_SECRET_KEY": "bench",
+        "FARM_TEAM_TOKEN": "bench",
+        "FARM_TEAMS": "10.60.{1..10}.1",
+        "FARM_SYSTEM_URL": f"{fake.url}/flags",
+        "FARM_DATABASE": database,
+        "FARM_TICK_DURATION": str(args.tick_duration),
+        "FARM_FLAG_LIFETIME": str(args.flag_lifetime),
+        "FARM_SUBMIT_PERIOD": str(args.submit_period),
+        "FARM_BATCH_LIMIT": str(args.batch_limit),
+        "FARM_FLAG_STORE": args.flag_store,
+        "FARM_FLAG_STORE_PATH": os.path.join(workdir, "flag-store"),
+    }
+    for entry in args.server_env:
+        key, _, value = entry.partition("=")
+        env[key] = value
+
+    log_path = os.path.join(workdir, "server.log")
+    with open(log_path, "wb") as log_file:
+        server = subprocess.Popen(
+            [sys.executable, "main.py"],
+            cwd=_SERVER_DIR,
+            env=env,
+            stdout=log_file,
+            stderr=log_file,
+        )
+    try:
+        wait_for_server(url, server, 30)
+        clients = [
+            Client(url, f"bench{i}", args.rate / args.clients, args.batch)
+            for i in range(args.clients)
+        ]
+        threads = [Thread(target=x.run, args=(args.duration,)) for x in clients]
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ingest_time = perf_counter() - start
+
+        # Give the submitter some time to catch up
+        sent: dict[str, float] = {}
+        for client in clients:
+            sent.update(client.sent)
+        drain_deadline = perf_counter() + args.drain
+        while perf_counter() < drain_deadline:
+            with fake.lock:
+                if len(fake.received) >= len(sent):
+                    break
+            sleep(0.5)
+        total_time = perf_counter() - start
+        statuses = count_statuses(url)
+    finally:
+        server.terminate()
+        server.wait()
+        fake.stop()
+
+    with fake.lock:
+        received = dict(fake.received)
+    latencies = [x for client in clients for x in client.latencies]
+    to_accepted = [
+        received[flag][0] - ts
+        for flag, ts in sent.items()
+        if flag in received and received[flag][1]
+    ]
+    submit_times = [x[0] for x in received.values()]
+    submit_window = max(submit_times) - min(submit_times) if submit_times else 0
+
+    results = {
+        "parameters": vars(args),
+        "ingest": {
+            "flags": len(sent),
+            "requests": len(latencies),
+            "errors": sum(x.errors for x in clients),
+            "throughput": len(sent) / ingest_time,
+            "latencyP50": percentile(latencies, 50),
+            "latencyP99": percentile(latencies, 99),
+            "latencyMax": max(latencies, default=None),
+        },
+        "submit": {
+            "flags": len(received),
+            "requests": fake.requests,
+            "rateLimited": fake.rate_limited,
+            "throughput": len(received) / submit_window if submit_window else None,
+            "ingestToAcceptedP50": percentile(to_accepted, 50),
+            "ingestToAcceptedP99": percentile(to_accepted, 99),
+        },
+        "lost": len([x for x in sent if x not in received]),
+        "statuses": statuses,
+        "storage": measure_storage(database) if args.flag_store == "sqlite" else None,
+        "duration": total_time,
+    }
+
+    if args.keep:
+        print(f"Server log and database kept in {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir)
+    return results
+
+
+def print_summary(results: dict) -> None:
+    def ms(value: float | None) -> str:
+        return "-" if value is None else f"{value * 1000:.1f}ms"
+
+    def s(value: float | None) -> str:
+        return "-" if value is None else f"{value:.2f}s"
+
+    ingest = results["ingest"]
+    submit = results["submit"]
+    print(f"Ingest:    {ingest['flags']} flags, {ingest['throughput']:.0f} flags/s")
+    print(
+        f"           /api/flags p50 {ms(ingest['latencyP50'])}, "
+        f"p99 {ms(ingest['latencyP99'])}, max {ms(ingest['latencyMax'])}, "
+        f"{ingest['errors']} errors"
+    )
+    throughput = submit["throughput"]
+    print(
+        f"Submit:    {submit['flags']} flags in {submit['requests']} requests "
+        f"({submit['rateLimited']} rate limited), "
+        f"{'-' if throughput is None else f'{throughput:.0f}'} flags/s"
+    )
+    print(
+        f"           ingest to accepted p50 {s(submit['ingestToAcceptedP50'])}, "
+        f"p99 {s(submit['ingestToAcceptedP99'])}"
+    )
+    print(f"Lost:      {results['lost']} flags never reached the checksystem")
+    print(f"Statuses:  {results['statuses']}")
+    if (storage := results["storage"]) is not None and storage["bytesPerFlag"]:
+        print(
+            f"Storage:   {storage['bytes'] / 2**20:.1f}MiB for {storage['flags']} flags, "
+            f"{storage['bytesPerFlag']:.0f} bytes per flag"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=500, help="flags/s in total")
+    parser.add_argument("--batch", type=int, default=50, help="flags per request")
+    parser.add_argument(
+        "--drain", type=float, default=30, help="max seconds to wait for the submitter"
+    )
+    parser.add_argument("--system-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--system-rate-limit", type=float, default=0, help="requests/s, 0 for none"
+    )
+    parser.add_argument("--accept-ratio", type=float, default=0.8)
+    parser.add_argument("--tick-duration", type=int, default=10)
+    parser.add_argument("--flag-lifetime", type=int, default=5)
+    parser.add_argument("--submit-period", type=int, default=1)
+    parser.add_argument("--batch-limit", type=int, default=1000)
+    parser.add_argument("--flag-store", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument(
+        "--server-env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra environment variables for the server",
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the server log and database"
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Micro-benchmark of the extraction of the flags from the output of the exploits.
+
+Compares the old path of start_sploit.py (decoding the whole output and running
+re.findall on it) with searching the bytes directly, with and without the prefilter
+the server derives from the flag format, on large synthetic outputs.
+"""
+
+import os
+import re
+import sys
+import base64
+import random
+import string
+import argparse
+
+from time import perf_counter
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+_CHUNK = 64 * 1024
+
+
+def load_modules() -> tuple:
+    # The server reads its configuration on import, none of it matters here
+    for key in ("PASSWORD", "SECRET_KEY", "TEAM_TOKEN", "TEAMS", "SYSTEM_URL"):
+        os.environ.setdefault(f"FARM_{key}", "http://127.0.0.1:1/bench")
+    os.environ.setdefault("FARM_LOG_LEVEL", "warning")
+    sys.path.insert(0, os.path.join(_ROOT, "server"))
+    sys.path.insert(0, os.path.join(_ROOT, "client"))
+    import flagmatch
+    import start_sploit
+
+    return flagmatch, start_sploit
+
+
+def html_page(rng: random.Random, size: int) -> bytes:
+    vocabulary = [
+        "".join(rng.choices(string.ascii_letters, k=rng.randint(2, 10)))
+        for _ in range(1000)
+    ]
+    rows, length = [], 0
+    while length < size:
+        words = " ".join(rng.choices(vocabulary, k=12))
+        rows.append(f'<tr><td class="c{rng.randint(0, 9)}">{words}</td></tr>\n')
+        length += len(rows[-1])
+    return "".join(rows).encode()
+
+
+def database_dump(rng: random.Random, size: int) -> bytes:
+    # Long base64 lines full of uppercase letters, digits and '='
+    lines, length = [], 0
+    while length < size:
+        lines.append(base64.b64encode(rng.randbytes(rng.randint(40, 400))) + b"\n")
+        length += len(lines[-1])
+    return b"".join(lines)
+
+
+def uppercase_noise(rng: random.Random, size: int) -> bytes:
+    # The worst case for the flag format: almost everything looks like a flag
+    alphabet = string.ascii_uppercase + string.digits + " \n"
+    return "".join(rng.choices(alphabet, k=size)).encode()
+
+
+_OUTPUTS = {"html": html_page, "dump": database_dump, "noise": uppercase_noise}
+
+
+def random_flag(rng: random.Random, pattern: re.Pattern) -> bytes:
+    # Flags of the default format, regenerated until they match the configured one
+    for _ in range(1000):
+        flag = "".join(rng.choices(string.ascii_uppercase + string.digits, k=31)) + "="
+        if pattern.fullmatch(flag):
+            return flag.encode()
+    raise ValueError("Pass a flag with --flag for this flag format")
+
+
+def plant(rng: random.Random, data: bytes, flags: list[bytes]) -> bytes:
+    positions = sorted(rng.randrange(len(data)) for _ in flags)
+    parts, last = [], 0
+    for position, flag in zip(positions, flags):
+        parts += [data[last:position], b" ", flag, b"\n"]
+        last = position
+    parts.append(data[last:])
+    return b"".join(parts)
+
+
+def measure(function, repeat: int) -> tuple[float, list]:
+    best, result = None, None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=float, default=8, help="MiB of output")
+    parser.add_argument("--flags", type=int, default=50, help="flags in the output")
+    parser.add_argument("--format", default="[A-Z0-9]{31}=", help="the flag format")
+    parser.add_argument("--flag", help="a flag of the format, if not the default one")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    flagmatch, client = load_modules()
+    prefilter = flagmatch.prefilter(args.format)
+    print(f"Flag format {args.format}, prefilter {prefilter}")
+    pattern = re.compile(args.format, re.MULTILINE)
+    rng = random.Random(args.seed)
+
+    def old() -> list:
+        return pattern.findall(output.decode())
+
+    def whole() -> list:
+        return client.find_flags(output)[0]
+
+    def chunked() -> list:
+        pending, pos, found = bytearray(), 0, []
+        context = client.cfg["flagMatcher"]["context"]
+        for offset in range(0, len(output), _CHUNK):
+            pending += output[offset : offset + _CHUNK]
+            flags, pos = client.find_flags(pending, pos, final=False)
+            found += flags
+            if pos > context:
+                del pending[: pos - context]
+                pos = context
+        return found + client.find_flags(pending, pos)[0]
+
+    matchers = {
+        "bytes": client.compile_flag_matcher(args.format, None),
+        "prefilter": client.compile_flag_matcher(args.format, prefilter),
+    }
+    paths = [
+        ("decode + re.findall", None, old),
+        ("bytes", "bytes", whole),
+        ("bytes + prefilter", "prefilter", whole),
+        ("chunked + prefilter", "prefilter", chunked),
+    ]
+    size = int(args.size * 2**20)
+    print(f"{'OUTPUT':<8} {'PATH':<22} {'TIME':>10} {'MiB/s':>9} {'FLAGS':>6}")
+    for name, generate in _OUTPUTS.items():
+        flags = [
+            args.flag.encode() if args.flag else random_flag(rng, pattern)
+            for _ in range(args.flags)
+        ]
+        output = plant(rng, generate(rng, size), flags)
+        expected = None
+        for label, matcher, function in paths:
+            if matcher is not None:
+                client.cfg["flagMatcher"] = matchers[matcher]
+            elapsed, found = measure(function, args.repeat)
+            found = [x if isinstance(x, str) else x.decode() for x in found]
+            if expected is None:
+                expected = found
+            elif found != expected:
+                print(f"{label} found different flags than re.findall!")
+            print(
+                f"{name:<8} {label:<22} {elapsed * 1000:>8.1f}ms "
+                f"{len(output) / 2**20 / elapsed:>9.0f} {len(found):>6}"
+            )
+
+
+if __name__ == "__main__":
+    main()
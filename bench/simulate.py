@@ -0,0 +1,377 @@
+"""Replays a whole game against the farm on a virtual clock.
+
+Imports the server in-process, makes it follow a clock that jumps straight to the next
+event and drives its worker step by step, while simulated start_sploit clients push the
+flags of every tick and a simulated checksystem judges them. An 8 hour game takes a
+minute or two, so batch_limit, submit_period and flag_lifetime can be chosen by
+looking at the queue depth, expiry losses and database size over the whole game.
+"""
+
+import os
+import sys
+import json
+import heapq
+import random
+import string
+import shutil
+import argparse
+import tempfile
+
+from time import perf_counter, time
+
+_SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+_FLAG_ALPHABET = string.ascii_uppercase + string.digits
+
+# The events of the game, in the order they are run when they happen at the same time
+_TICK = 0
+_WAVE = 1
+_WORKER = 2
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def parse_outage(value: str) -> tuple[float, float]:
+    start, _, duration = value.partition(",")
+    return float(start) * 60, float(duration or 5) * 60
+
+
+def configure(args: argparse.Namespace, workdir: str, start: int) -> None:
+    # The configuration is read when the modules are imported
+    os.environ.update(
+        {
+            "FARM_PASSWORD": "simulation",
+            "FARM_SECRET_KEY": "simulation",
+            "FARM_TEAM_TOKEN": "simulation",
+            "FARM_TEAMS": f"10.60.{{1..{args.teams}}}.1",
+            "FARM_SYSTEM_URL": "http://127.0.0.1:1/flags",
+            "FARM_DATABASE": os.path.join(workdir, "flags.db"),
+            "FARM_TICK_START": str(start),
+            "FARM_TICK_DURATION": str(args.tick_duration),
+            "FARM_FLAG_LIFETIME": str(args.flag_lifetime),
+            "FARM_SUBMIT_PERIOD": str(args.submit_period),
+            "FARM_SUBMIT_TIMEOUT": str(args.submit_timeout),
+            "FARM_BATCH_LIMIT": str(args.batch_limit),
+            "FARM_FLAG_STORE": args.flag_store,
+            "FARM_FLAG_STORE_PATH": os.path.join(workdir, "flag-store"),
+            "FARM_LOG_LEVEL": "warning",
+        }
+    )
+    for entry in args.server_env:
+        key, _, value = entry.partition("=")
+        os.environ[key] = value
+    os.chdir(_SERVER_DIR)
+    sys.path.insert(0, _SERVER_DIR)
+
+
+def storage_size(workdir: str) -> int:
+    size = 0
+    for directory, _, names in os.walk(workdir):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return size
+
+
+def run(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix="farm-simulation-")
+    # Align the game to the ticks, starting from now so that the logs make sense
+    start = int(time()) // args.tick_duration * args.tick_duration
+    configure(args, workdir, start)
+
+    import flags
+    import worker
+    import timeutils
+
+    from app import app
+    from database import db, migrate
+    from sqlalchemy import text
+
+    class VirtualClock(timeutils.Clock):
+        def __init__(self, now: float):
+            self.now = now
+
+        def time(self) -> float:
+            return self.now
+
+        def sleep(self, seconds: float) -> None:
+            self.now += max(seconds, 0)
+
+    class Checksystem(worker.Submitter):
+        """Accepts a share of the flags still valid in the game, like ForcAD."""
+
+        def __init__(self, clock: VirtualClock):
+            self.clock = clock
+            self.rng = random.Random(args.seed)
+            self.outages = [(start + x, start + x + y) for x, y in args.outage]
+            # flag -> start of the tick the flag was put in the game
+            self.valid: dict[str, int] = {}
+            self.lifetime = args.system_lifetime * args.tick_duration
+            self.requests = 0
+            self.failed = 0
+            self.accepted = 0
+            self.too_old = 0
+
+        def _send(self, batch: list[str]) -> list[worker.SubmitterResponse]:
+            self.requests += 1
+            if any(x <= self.clock.now < y for x, y in self.outages):
+                # The request times out, then the worker carries on as usual
+                self.clock.sleep(args.submit_timeout)
+                self.failed += 1
+                return []
+            self.clock.sleep(args.system_latency)
+            responses = []
+            for flag in batch:
+                if (placed := self.valid.pop(flag, None)) is None:
+                    status, message = flags.STATUS_REJECTED, "Resubmit"
+                elif self.clock.now - placed > self.lifetime:
+                    status, message = flags.STATUS_REJECTED, "Denied: flag is too old"
+                    self.too_old += 1
+                elif self.rng.random() < args.accept_ratio:
+                    status, message = flags.STATUS_ACCEPTED, "Accepted"
+                    self.accepted += 1
+                else:
+                    status, message = flags.STATUS_REJECTED, "Denied: no such flag"
+                responses.append(worker.SubmitterResponse(flag, status, message))
+            return responses
+
+    def measure_storage() -> int:
+        # Move the WAL back into the database, which is never checkpointed otherwise
+        # in such a short game, so that its size is not counted twice
+        if args.flag_store == "sqlite":
+            db.session.commit()
+            db.session.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+            db.session.commit()
+        return storage_size(workdir)
+
+    clock = VirtualClock(start)
+    timeutils.use_clock(clock)
+    checksystem = Checksystem(clock)
+    farm = worker.Worker(checksystem)
+    rng = random.Random(args.seed)
+    teams = [f"10.60.{i}.1" for i in range(1, args.teams + 1)]
+    ticks = int(args.hours * 3600 // args.tick_duration)
+    end = start + ticks * args.tick_duration
+
+    events = [(start, _TICK, 0, 0), (start, _WORKER, 1, None)]
+    sequence = 2
+    samples = []
+    # The most flags pending since the last sample. Only the waves add flags, and
+    # they mostly arrive and get submitted in between the ticks.
+    peak = 0
+    captured = 0
+    wall_start = perf_counter()
+    with app.app_context():
+        db.create_all()
+        migrate()
+        while events:
+            when, kind, _, payload = heapq.heappop(events)
+            if when >= end:
+                break
+            # Events that should have happened while the worker was busy run late
+            clock.now = max(clock.now, when)
+            if kind == _TICK:
+                counts = flags.count_by_status()
+                samples.append(
+                    {
+                        "tick": payload,
+                        "pending": counts["pending"],
+                        "peakPending": max(peak, counts["pending"]),
+                        "expired": counts["expired"],
+                        "accepted": counts["accepted"],
+                        "storageBytes": measure_storage(),
+                    }
+                )
+                peak = counts["pending"]
+                # Every exploit is run by its own client, which pushes the flags of
+                # all the teams once its wave is over
+                for exploit in range(args.exploits):
+                    wave_end = when + rng.uniform(0, args.wave_time)
+                    found = []
+                    for team in teams:
+                        if rng.random() >= args.success:
+                            continue
+                        ts = int(rng.uniform(when, wave_end))
+                        for _ in range(args.flags_per_run):
+                            flag = "".join(rng.choices(_FLAG_ALPHABET, k=31)) + "="
+                            checksystem.valid[flag] = when
+                            found.append({"flag": flag, "ts": ts, "team": team})
+                    captured += len(found)
+                    event = (wave_end, _WAVE, sequence, (f"exploit{exploit}", found))
+                    heapq.heappush(events, event)
+                    sequence += 1
+                event = (when + args.tick_duration, _TICK, sequence, payload + 1)
+                heapq.heappush(events, event)
+                sequence += 1
+                if payload % max(1, 3600 // args.tick_duration) == 0 and payload > 0:
+                    elapsed = perf_counter() - wall_start
+                    print(
+                        f"Simulated {payload} ticks in {elapsed:.1f}s, "
+                        f"{counts['pending']} flags pending",
+                        file=sys.stderr,
+                    )
+            elif kind == _WAVE:
+                exploit, found = payload
+                flags.queue(exploit, found)
+                peak = max(peak, flags.count_by_status()["pending"])
+            else:
+                delay = farm.step()
+                event = (clock.now + max(delay, 0), _WORKER, sequence, None)
+                heapq.heappush(events, event)
+                sequence += 1
+        clock.now = end
+        final = flags.count_by_status()
+        wall_time = perf_counter() - wall_start
+        storage = measure_storage()
+
+    pending = [x["peakPending"] for x in samples]
+    results = {
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "game": {
+            "ticks": ticks,
+            "seconds": end - start,
+            "wallTime": wall_time,
+            "speedup": (end - start) / wall_time,
+        },
+        "flags": {
+            "captured": captured,
+            "accepted": checksystem.accepted,
+            "expired": final["expired"],
+            "tooOld": checksystem.too_old,
+            "pending": final["pending"],
+            "statuses": final,
+        },
+        "queue": {
+            "max": max(pending, default=0),
+            "p95": percentile(pending, 95),
+            "p50": percentile(pending, 50),
+        },
+        "submit": {
+            "requests": checksystem.requests,
+            "failed": checksystem.failed,
+        },
+        "storage": {
+            "bytes": storage,
+            "bytesPerFlag": storage / captured if captured else None,
+        },
+        "samples": samples,
+    }
+
+    if args.keep:
+        print(f"Database kept in {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir)
+    return results
+
+
+def print_summary(results: dict) -> None:
+    game = results["game"]
+    parameters = results["parameters"]
+    counts = results["flags"]
+    queue = results["queue"]
+    submit = results["submit"]
+    storage = results["storage"]
+    print(
+        f"Game:      {game['seconds'] / 3600:.1f}h, {game['ticks']} ticks, "
+        f"{parameters['teams']} teams, {parameters['exploits']} exploits, simulated "
+        f"in {game['wallTime']:.1f}s ({game['speedup']:.0f}x)"
+    )
+    print(
+        f"Flags:     {counts['captured']} captured, {counts['accepted']} accepted, "
+        f"{counts['pending']} still pending"
+    )
+    print(
+        f"Losses:    {counts['expired']} expired in the farm, "
+        f"{counts['tooOld']} too old for the checksystem"
+    )
+    print(
+        f"Queue:     max {queue['max']} pending, p95 {queue['p95']}, p50 {queue['p50']}"
+    )
+    print(f"Submit:    {submit['requests']} requests, {submit['failed']} failed")
+    if storage["bytesPerFlag"]:
+        print(
+            f"Storage:   {storage['bytes'] / 2**20:.1f}MiB at the end of the game, "
+            f"{storage['bytesPerFlag']:.0f} bytes per flag"
+        )
+    # One line per hour of game, to see where the queue builds up
+    samples = results["samples"]
+    step = max(1, 3600 // parameters["tick_duration"])
+    print(
+        f"{'TICK':>6} {'PENDING':>9} {'PEAK':>9} {'EXPIRED':>9} {'ACCEPTED':>9} "
+        f"{'STORAGE':>9}"
+    )
+    for sample in samples[::step] + samples[-1:]:
+        print(
+            f"{sample['tick']:>6} {sample['pending']:>9} {sample['peakPending']:>9} "
+            f"{sample['expired']:>9} {sample['accepted']:>9} "
+            f"{sample['storageBytes'] / 2**20:>8.1f}M"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hours", type=float, default=8, help="length of the game")
+    parser.add_argument("--teams", type=int, default=30)
+    parser.add_argument("--exploits", type=int, default=5)
+    parser.add_argument(
+        "--success", type=float, default=0.7, help="chance of an exploit hitting a team"
+    )
+    parser.add_argument("--flags-per-run", type=int, default=1)
+    parser.add_argument(
+        "--wave-time", type=float, default=30, help="max seconds of a wave of a client"
+    )
+    parser.add_argument("--accept-ratio", type=float, default=0.95)
+    parser.add_argument(
+        "--system-lifetime",
+        type=int,
+        default=5,
+        help="ticks for which the checksystem accepts a flag",
+    )
+    parser.add_argument(
+        "--system-latency", type=float, default=0.2, help="seconds per request"
+    )
+    parser.add_argument(
+        "--outage",
+        type=parse_outage,
+        action="append",
+        default=[],
+        metavar="START,DURATION",
+        help="minutes into the game when the checksystem stops answering, and for how "
+        "many minutes",
+    )
+    parser.add_argument("--tick-duration", type=int, default=120)
+    parser.add_argument("--flag-lifetime", type=int, default=5)
+    parser.add_argument("--submit-period", type=int, default=10)
+    parser.add_argument("--submit-timeout", type=int, default=10)
+    parser.add_argument("--batch-limit", type=int, default=1000)
+    parser.add_argument("--flag-store", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--server-env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="extra environment variables for the server",
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the database")
+    args = parser.parse_args()
+    if args.output:
+        # The server runs from its own directory
+        args.output = os.path.abspath(args.output)
+
+    results = run(args)
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
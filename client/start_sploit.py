@@ -4,14 +4,20 @@ import os
 import re
 import sys
 import platform
+import shlex
+import signal
 import shutil
-from random import randint
+import json
+import pstats
+import tempfile
 from time import time, sleep
 
-from requests import Session, ConnectionError
+from requests import Session, ConnectionError, RequestException
 from json import JSONDecodeError
-from subprocess import run as run_process, Popen, CalledProcessError, TimeoutExpired
+from subprocess import run as run_process, Popen, PIPE, DEVNULL
+from subprocess import CalledProcessError, TimeoutExpired
 from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Thread
 
 this_os = platform.system().lower()
 this_arch = platform.machine()
@@ -23,8 +29,74 @@ cfg = {}  # server configuration
 # wave state
 wave = 1
 
-# failure filter
-failure_counters = {}
+# exploits currently being run, and files that were rejected, along with their mtime
+exploits = []
+rejected_exploits = {}
+
+# failure backoff, indexed by "exploit/team"
+backoff = {}
+backoff_lock = Lock()
+BACKOFF_FILE = "start_sploit-backoff.json"
+
+# flags already uploaded to the server, along with when they expire
+seen_flags = {}
+seen_lock = Lock()
+SEEN_FILE = "start_sploit-seen.json"
+
+# per-team flag statistics from the server, indexed by exploit name
+server_stats = {}
+
+# attack data of the current tick, serialized for every team
+attack_data = {}
+
+# difference between the clock of the server and ours, and a measure of it taken
+# along with the configuration, with its round trip time
+clock_offset = 0.0
+config_clock_sample = None
+
+# jobs leased from the server that still have to be completed, indexed by lease
+leases = {}
+leases_lock = Lock()
+# attempts at the requests about jobs when the server is busy or unreachable, and the
+# longest wait between them
+LEASE_ATTEMPTS = 5
+LEASE_MAX_DELAY = 10
+
+# launch plans, indexed by exploit path
+launch_plans = {}
+
+# timings of the runs of the current wave, and the self time of the functions of every
+# exploit, when profiling
+wave_timings = []
+hotspots = {}
+profile_lock = Lock()
+# samples per second taken by py-spy
+PROFILE_RATE = 100
+# runs and functions shown in the profile of every wave
+PROFILE_ROWS = 10
+# seconds to wait for the output of a run once it is over
+PROFILE_JOIN_TIMEOUT = 5
+# runs an exploit under cProfile, which unlike "python -m cProfile" keeps its exit status
+CPROFILE_BOOTSTRAP = """
+import os, sys, runpy, cProfile
+path, sys.argv = sys.argv[1], sys.argv[2:]
+sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+profile = cProfile.Profile()
+try:
+    profile.runcall(runpy.run_path, sys.argv[0], run_name="__main__")
+finally:
+    profile.dump_stats(path)
+"""
+
+ELF_MAGIC = b"\x7fELF"
+PE_MAGIC = b"MZ"
+MACHO_MAGICS = (
+    b"\xfe\xed\xfa\xce",
+    b"\xfe\xed\xfa\xcf",
+    b"\xce\xfa\xed\xfe",
+    b"\xcf\xfa\xed\xfe",
+    b"\xca\xfe\xba\xbe",
+)
 
 BLACK = 0
 RED = 1
@@ -58,17 +130,35 @@ def highlight(message: str, color: int):
 
 
 def usage():
-    print(f"""USAGE: {sys.argv[0]} [OPTIONS] EXPLOIT
+    print(f"""USAGE: {sys.argv[0]} [OPTIONS] EXPLOIT [EXPLOIT...]
+
+Each EXPLOIT can either be a file or a directory. Directories are scanned before every wave, so that exploits
+dropped into them get picked up without restarting the script. Files starting with '.' or '_' are ignored.
 
 The possible value for OPTIONS are:
   --server-url URL         The URL of the server running H4PPY Farm.
   --server-pass PASSWORD   The password of the H4PPY Farm server.
   --timeout TIMEOUT        The amount of time in seconds after which an instance of the exploit should be killed.
+  --interpreter CMD        The command used to run the exploits (e.g. "pypy3" or "node --no-warnings"), overriding
+                           the detected one. Use NAME=CMD to only override the interpreter of the exploit NAME,
+                           multiple entries can be separated by commas.
+  --attack-data-stdin      Also write the attack data of the team to the standard input of the exploit, besides passing
+                           it through the ATTACK_DATA environment variable.
+  --tick-delay SECONDS     How long to wait after the start of a tick before launching a new wave, when the server
+                           knows when the game started.
   --always-retry           Always try exploit on targets on which it always seems to fail.
-  --failure-threshold N    The number of consecutive failures for one team, after which the script should start
-                           decreasing the probability of running the exploit on that one team.
-  --max-failures MAX       The maximum amount of failures after which the probability of running the exploit stops
-                           decreasing.
+  --failure-threshold N    The number of consecutive failures for one team, after which the script should stop
+                           running the exploit on that team, and only retry it after an exponentially growing delay.
+  --max-failures MAX       The maximum amount of failures after which the retry delay stops growing.
+  --server-stats           Also count as failures the runs on teams whose flags are all being rejected by the game
+                           system, according to the server.
+  --distributed            Get the teams to attack from the server, so that multiple machines running the same
+                           exploits split the teams among themselves instead of attacking all of them.
+  --runner NAME            The name of this machine shown by the server when running with --distributed.
+  --profile                Record the wall time, time to the first flag, exit status and output size of every run,
+                           print the slowest runs after every wave and send the timings to the server.
+  --profile-python         Like --profile, but also run Python exploits under py-spy (or cProfile, much slower, if
+                           py-spy is not installed) and print their hottest functions. py-spy hides exit statuses.
   --help                   Print this message.
     """)
     exit(-1)
@@ -97,11 +187,19 @@ def parse_args():
     config_keys = {
         "server-url": None,
         "server-pass": None,
-        "timeout": 10,
+        "timeout": 10.0,
+        "interpreter": "",
         "fake-timestamps": False,
         "always-retry": False,
+        "server-stats": False,
+        "tick-delay": 2.0,
+        "attack-data-stdin": False,
         "max-failures": 12,
         "failure-threshold": 4,
+        "distributed": False,
+        "runner": f"{platform.node()}-{os.getpid()}",
+        "profile": False,
+        "profile-python": False,
     }
 
     for arg, default in config_keys.items():
@@ -109,10 +207,31 @@ def parse_args():
             if default is None:
                 usage()
             arg_val = default
-        elif isinstance(default, int | float):
-            arg_val = float(arg_val)
+        elif isinstance(default, int | float) and not isinstance(default, bool):
+            try:
+                arg_val = type(default)(arg_val)
+            except ValueError:
+                usage()
         params[arg] = arg_val
-    params["exploit"] = os.path.join("./", sys.argv[-1])
+    params["exploits"] = get_positional_args(config_keys)
+    params["profile"] = params["profile"] or params["profile-python"]
+    if len(params["exploits"]) == 0:
+        usage()
+
+
+def get_positional_args(config_keys: dict[str, str | int | None]) -> list[str]:
+    args = []
+    idx = 1
+    while idx < len(sys.argv):
+        arg = sys.argv[idx]
+        if arg.startswith("--"):
+            if (key := arg[2:]) not in config_keys:
+                usage()
+            idx += 1 if isinstance(config_keys[key], bool) else 2
+        else:
+            args.append(os.path.join("./", arg))
+            idx += 1
+    return args
 
 
 def url_for(endpoint) -> str:
@@ -152,16 +271,22 @@ def authenticate() -> Session:
 
 
 def get_config(session: Session):
-    global cfg
+    global cfg, config_clock_sample
 
     try:
+        t0 = time()
         res = session.get(url_for("/api/config"))
+        t1 = time()
         remote_cfg = res.json()
+        if isinstance(server_now := remote_cfg.pop("serverTime", None), int | float):
+            config_clock_sample = (t1 - t0, server_now - (t0 + t1) / 2)
         for key, val in remote_cfg.items():
-            if key == "flagFormat":
-                cfg[key] = re.compile(val, re.MULTILINE)
-            else:
-                cfg[key] = val
+            cfg[key] = val
+        if "flagFormat" in remote_cfg:
+            prefilter = remote_cfg.get("flagPrefilter")
+            cfg["flagMatcher"] = compile_flag_matcher(
+                remote_cfg["flagFormat"], prefilter
+            )
     except ConnectionError:
         print("Could not retrieve configuration, continuing anyways...")
     except JSONDecodeError:
@@ -170,9 +295,111 @@ def get_config(session: Session):
     if not ("teams" in cfg):
         print("No configuration loaded!")
         exit(-1)
+
+
+def compile_flag_matcher(pattern: str, prefilter: dict | None) -> dict:
+    # older servers don't send a prefilter, the whole output is searched then
+    prefilter = prefilter or {}
+    literal = prefilter.get("literal")
+    regex = re.compile(pattern.encode(), re.MULTILINE)
+    return {
+        "regex": regex,
+        # like re.findall(), the flag is what the group matches when there is one
+        "group": 1 if regex.groups == 1 else 0,
+        "literal": re.compile(re.escape(literal.encode())) if literal else None,
+        "offset": prefilter.get("offset", 0),
+        "maxLength": prefilter.get("maxLength"),
+        "context": prefilter.get("context", 1),
+    }
+
+
+def find_flags(
+    data: bytes | bytearray | memoryview, pos: int = 0, final: bool = True
+) -> (list[bytes], int):
+    """Finds the flags in the output of an exploit without decoding it, returning them
+    along with where the search must resume. Unless the output is final, the flags
+    that more output could still change are left for the next search."""
+    matcher = cfg["flagMatcher"]
+    regex, literal, offset = matcher["regex"], matcher["literal"], matcher["offset"]
+    group, max_length = matcher["group"], matcher["maxLength"]
+    if final:
+        limit = len(data)
+    elif max_length is None:
+        return [], pos
     else:
-        for team in filter(lambda x: not (x in failure_counters), cfg["teams"]):
-            failure_counters[team] = 0
+        # leave room for the lookarounds right after the flag (e.g. \b or $)
+        limit = len(data) - max_length - matcher["context"]
+
+    flags = []
+    if literal is None:
+        for match in regex.finditer(data, pos):
+            if match.start() > limit:
+                break
+            if match.end() > match.start():
+                if flag := match.group(group):
+                    flags.append(bytes(flag))
+                pos = match.end()
+    else:
+        # every flag has the literal at the same offset, so only the places where it
+        # appears are worth trying the whole flag format on
+        while (found := literal.search(data, pos + offset)) is not None:
+            start = found.start() - offset
+            if start > limit:
+                break
+            if (match := regex.match(data, start)) and match.end() > start:
+                if flag := match.group(group):
+                    flags.append(bytes(flag))
+                pos = match.end()
+            else:
+                pos = start + 1
+    return flags, len(data) if final else max(pos, limit + 1)
+
+
+def sync_clock(session: Session, samples: int = 3):
+    global clock_offset, config_clock_sample
+
+    # the configuration came with the time of the server, which is a sample too
+    best, config_clock_sample = config_clock_sample, None
+    try:
+        for _ in range(samples):
+            t0 = time()
+            res = session.get(url_for("/api/time"), timeout=5)
+            t1 = time()
+            if res.status_code != 200:
+                break
+            # like NTP, assume the request and the response took the same time, and
+            # trust the sample with the smallest round trip time the most
+            offset = res.json()["time"] - (t0 + t1) / 2
+            if best is None or t1 - t0 < best[0]:
+                best = (t1 - t0, offset)
+    except (ConnectionError, JSONDecodeError, KeyError, TypeError):
+        print(highlight("Could not synchronize the clock with the server", YELLOW))
+    if best:
+        clock_offset = best[1]
+
+
+def server_time() -> float:
+    global clock_offset
+
+    return time() + clock_offset
+
+
+def get_tick(timestamp: float) -> int | None:
+    global cfg
+
+    if (tick_start := cfg.get("tickStart")) is None:
+        return None
+    return math.floor((timestamp - tick_start) / cfg["tickDuration"])
+
+
+def get_wait_time(wave_tick: int | None, wave_time: float, deadline: float) -> float:
+    global cfg, params
+
+    if wave_tick is None:
+        return deadline - wave_time
+    # fire once per tick, right after it starts
+    next_wave = cfg["tickStart"] + (wave_tick + 1) * cfg["tickDuration"]
+    return next_wave + params["tick-delay"] - server_time()
 
 
 def linux_set_capabilities(file: str, caps: list[str]) -> bool:
@@ -315,175 +542,950 @@ def launch_hfi(session: Session):
         pass
 
 
-def check_exploit():
+def exploit_name(exploit: str) -> str:
+    return os.path.basename(exploit).split(".", 1)[0]
+
+
+def is_python_command(command: str) -> bool:
+    name = os.path.basename(command).lower()
+    return name.startswith("python") or name.startswith("pypy")
+
+
+def get_interpreter(exploit: str) -> str | None:
     global params
 
-    exploit = params["exploit"]
+    default = None
+    for entry in filter(None, params["interpreter"].split(",")):
+        name, sep, command = entry.partition("=")
+        if not sep or " " in name.strip():
+            default = entry.strip()
+        elif name.strip() == exploit_name(exploit):
+            return command.strip()
+    return default
+
+
+def parse_shebang(line: bytes) -> list[str]:
+    # the kernel passes at most one argument to the interpreter
+    interpreter, *arg = line[2:].decode(errors="replace").strip().split(None, 1)
+    return [interpreter, *arg]
+
+
+def detect_launch_plan(exploit: str) -> (list[str], bool):
+    """Returns the command used to run the exploit and whether it's a Python script."""
+    global params, this_os
+
+    if interpreter := get_interpreter(exploit):
+        args = shlex.split(interpreter, posix=this_os != "windows")
+        return [*args, exploit], is_python_command(args[0])
+
+    with open(exploit, "rb") as f:
+        header = f.readline(256)
+
+    if header.startswith(b"#!"):
+        shebang = parse_shebang(header)
+        if os.path.basename(shebang[0]) == "env" and len(shebang) > 1:
+            args = shebang[1].split()
+            command = next((x for x in args if not x.startswith("-")), args[0])
+        else:
+            command = shebang[0]
+        if this_os != "windows" and os.access(exploit, os.X_OK):
+            # let the kernel deal with the shebang
+            return [exploit], is_python_command(command)
+        if this_os == "windows":
+            if not (command_path := shutil.which(os.path.basename(command))):
+                raise ValueError(f"interpreter '{command}' not found")
+            return [command_path, exploit], is_python_command(command)
+        return [*shebang, exploit], is_python_command(command)
+
+    if header.startswith(ELF_MAGIC) or header.startswith(MACHO_MAGICS):
+        if this_os == "windows":
+            raise ValueError(
+                "native executables for Linux and macOS cannot run on Windows"
+            )
+        if not os.access(exploit, os.X_OK):
+            raise ValueError(f"the file is not executable (try 'chmod +x {exploit}')")
+        return [exploit], False
+
+    if header.startswith(PE_MAGIC):
+        if this_os != "windows":
+            raise ValueError("Windows executables can only run on Windows")
+        return [exploit], False
+
+    if exploit.endswith(".py"):
+        return ["python3", exploit], True
+
+    raise ValueError(
+        "unknown file type, add a shebang or use --interpreter to specify how to run it"
+    )
+
+
+def get_launch_plan(exploit: str) -> (list[str], bool):
+    global launch_plans
+
+    mtime = os.stat(exploit).st_mtime
+    if (plan := launch_plans.get(exploit)) and plan[0] == mtime:
+        return plan[1], plan[2]
+    args, is_python = detect_launch_plan(exploit)
+    launch_plans[exploit] = (mtime, args, is_python)
+    return args, is_python
+
+
+def check_exploit(exploit: str) -> bool:
     print(f"Checking exploit '{exploit}'...")
     try:
+        args, is_python = get_launch_plan(exploit)
+        print(f"Running exploit with: {shlex.join(args)} TEAM")
+        if not is_python:
+            return True
         with open(exploit, "r") as f:
             source = "\n".join(f.readlines())
             if re.search(r"flush\s*=\s*True", source) is None:
                 print(
                     "Please use print(..., flush=True) in your script, instead of just print(...)"
                 )
-                exit(-1)
-    except FileNotFoundError as exc:
+                return False
+        return True
+    except (OSError, UnicodeDecodeError) as exc:
         print(f"Could not open {exploit}: {exc}")
-        exit(-1)
+    except ValueError as exc:
+        print(f"Cannot run {exploit}: {exc}")
+    return False
 
 
-def run_exploit(team: str) -> list[dict[str, str | float]] | None:
-    global failure_counters, params, cfg
+def find_exploits() -> list[str]:
+    global params
 
-    failure_threshold = params["failure-threshold"]
-    # FIXME: Figure out why the fuck failure_counters[team] becomes a fucking float
-    if randint(0, int(failure_counters[team])) > failure_threshold:
-        # decrease the possibility of running the exploit on teams on which the exploit seems to fail the most
-        wprint(highlight(f"Not running exploit on {team} (too many failures)", YELLOW))
-        return None
-    flag_format = cfg["flagFormat"]
-    exploit = params["exploit"]
+    found = []
+    for path in params["exploits"]:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for entry in sorted(os.scandir(path), key=lambda x: x.name):
+            if entry.name[0] not in "._" and entry.is_file():
+                found.append(entry.path)
+    return found
+
+
+def refresh_exploits():
+    global exploits, rejected_exploits, params
+
+    found = find_exploits()
+    for exploit in found:
+        if exploit in exploits:
+            continue
+        try:
+            mtime = os.stat(exploit).st_mtime
+        except OSError:
+            mtime = None
+        if rejected_exploits.get(exploit) == mtime:
+            continue
+        if check_exploit(exploit):
+            rejected_exploits.pop(exploit, None)
+            wprint(highlight(f"Loaded exploit {exploit_name(exploit)}", CYAN))
+            exploits.append(exploit)
+        else:
+            rejected_exploits[exploit] = mtime
+            wprint(highlight(f"Skipping {exploit}", YELLOW))
+    for exploit in [x for x in exploits if x not in found]:
+        wprint(highlight(f"Exploit {exploit_name(exploit)} removed", YELLOW))
+        exploits.remove(exploit)
+
+
+def backoff_key(exploit: str, team: str) -> str:
+    return f"{exploit_name(exploit)}/{team}"
+
+
+def backoff_delay(failures: int) -> float:
+    global params, cfg
+
+    exponent = min(failures, params["max-failures"]) - params["failure-threshold"]
+    max_delay = cfg["tickDuration"] * cfg["flagLifetime"]
+    return min(cfg["tickDuration"] * 2 ** max(exponent, 0), max_delay)
+
+
+def get_backoff(key: str, now: float) -> dict[str, int | float]:
+    global backoff, cfg
+
+    state = backoff.setdefault(key, {"failures": 0, "retry": 0.0, "updated": now})
+    # halve the failures for every flag lifetime without new failures, so that targets
+    # that were down for a long time get a fresh chance
+    decay_period = cfg["tickDuration"] * cfg["flagLifetime"]
+    if (periods := int((now - state["updated"]) // decay_period)) > 0:
+        state["failures"] >>= min(periods, 32)
+        state["updated"] += periods * decay_period
+    return state
+
+
+def should_attack(exploit: str, team: str) -> bool:
+    global params
+
+    if params["always-retry"]:
+        return True
+    now = time()
+    with backoff_lock:
+        state = get_backoff(backoff_key(exploit, team), now)
+        if state["failures"] < params["failure-threshold"]:
+            return True
+        # half-open: once the delay is over, let a single probe through, its result
+        # will either reset the failures or push the next retry further away
+        if now >= state["retry"]:
+            state["retry"] = now + backoff_delay(state["failures"])
+            return True
+    return False
+
+
+def get_failures(exploit: str, team: str) -> int:
+    with backoff_lock:
+        return get_backoff(backoff_key(exploit, team), time())["failures"]
+
+
+def record_result(exploit: str, team: str, success: bool):
+    global backoff, params
+
+    now = time()
+    key = backoff_key(exploit, team)
+    with backoff_lock:
+        if success:
+            backoff.pop(key, None)
+            return
+        state = get_backoff(key, now)
+        state["failures"] = min(state["failures"] + 1, params["max-failures"])
+        state["updated"] = now
+        if state["failures"] >= params["failure-threshold"]:
+            state["retry"] = now + backoff_delay(state["failures"])
+
+
+def load_backoff():
+    global backoff
+
+    path = os.path.join(get_persistent_dir(), BACKOFF_FILE)
+    try:
+        with open(path, "r") as f:
+            if isinstance(data := json.load(f), dict):
+                backoff = data
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        print(highlight(f"Could not load failure backoff from {path}", YELLOW))
+
+
+def save_backoff():
+    path = os.path.join(get_persistent_dir(), BACKOFF_FILE)
+    try:
+        with backoff_lock:
+            data = json.dumps(backoff)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        wprint(highlight(f"Could not save failure backoff to {path}", YELLOW))
+
+
+def unseen_flags(run_flags: list[dict]) -> list[dict]:
+    global seen_flags
+
+    # exploits steal the same flags again on every wave while they are alive, only
+    # upload the ones the server hasn't got yet
+    now = time()
+    new_flags = {}
+    with seen_lock:
+        for flag in run_flags:
+            if seen_flags.get(flag["flag"], 0) <= now:
+                new_flags.setdefault(flag["flag"], flag)
+    return list(new_flags.values())
+
+
+def mark_seen(sent_flags: list[dict]):
+    global seen_flags, cfg
+
+    expiry = time() + cfg["tickDuration"] * cfg["flagLifetime"]
+    with seen_lock:
+        for flag in sent_flags:
+            seen_flags[flag["flag"]] = expiry
+
+
+def load_seen():
+    global seen_flags
+
+    path = os.path.join(get_persistent_dir(), SEEN_FILE)
+    try:
+        with open(path, "r") as f:
+            if isinstance(data := json.load(f), dict):
+                seen_flags = data
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        print(highlight(f"Could not load sent flags from {path}", YELLOW))
+
+
+def save_seen():
+    global seen_flags
+
+    path = os.path.join(get_persistent_dir(), SEEN_FILE)
+    try:
+        with seen_lock:
+            # the server would reject expired flags anyway, forget them
+            now = time()
+            seen_flags = {k: v for k, v in seen_flags.items() if v > now}
+            data = json.dumps(seen_flags)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        wprint(highlight(f"Could not save sent flags to {path}", YELLOW))
+
+
+def get_server_stats(session: Session):
+    global exploits, server_stats
+
+    for name in map(exploit_name, exploits):
+        try:
+            res = session.get(url_for(f"/api/stats/teams/{name}"), timeout=10)
+            if res.status_code == 200:
+                server_stats[name] = res.json()
+        except (ConnectionError, JSONDecodeError):
+            wprint(highlight(f"Could not get team statistics for {name}", YELLOW))
+
+
+def is_rejected(name: str, team: str) -> bool:
+    global server_stats
+
+    stats = server_stats.get(name, {}).get(team, {})
+    return stats.get("accepted", 0) == 0 and stats.get("rejected", 0) > 0
+
+
+def profiler_command(exploit: str, args: list[str], path: str) -> (list[str], bool):
+    """Wraps the command of a Python exploit with a profiler writing to the given path,
+    and tells whether it's a sampling one."""
+    if py_spy := shutil.which("py-spy"):
+        rate = str(PROFILE_RATE)
+        options = ["--format", "raw", "--rate", rate, "--output", path]
+        return [py_spy, "record", *options, "--", *args], True
+    # the last two arguments are the exploit and the team
+    if not (interpreter := args[:-2]):
+        with open(exploit, "rb") as f:
+            interpreter = parse_shebang(f.readline(256))
+    return [*interpreter, "-c", CPROFILE_BOOTSTRAP, path, *args[-2:]], False
+
+
+def collect_profile(name: str, path: str, sampled: bool):
+    global hotspots
+
+    functions = {}
+    try:
+        if sampled:
+            # every line is a stack, from the outermost frame, and its number of samples
+            with open(path, "r") as f:
+                for line in f:
+                    stack, _, samples = line.rstrip().rpartition(" ")
+                    if stack:
+                        function = stack.rsplit(";", 1)[-1]
+                        seconds = int(samples) / PROFILE_RATE
+                        functions[function] = functions.get(function, 0) + seconds
+        else:
+            for (file, line, function), entry in pstats.Stats(path).stats.items():
+                if file != "~":
+                    function = f"{function} ({os.path.basename(file)}:{line})"
+                functions[function] = functions.get(function, 0) + entry[2]
+    except (OSError, ValueError, TypeError, EOFError):
+        # the exploit was killed before the profile could be written
+        pass
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    with profile_lock:
+        totals = hotspots.setdefault(name, {})
+        for function, seconds in functions.items():
+            totals[function] = totals.get(function, 0) + seconds
+
+
+def run_profiled(
+    exploit: str, args: list[str], timeout: float, env: dict, stdin: bytes | None
+) -> (bytes, list[bytes], float | None):
+    """Works like run_process(), also returning the flags found while the exploit was
+    running and how long it took to print the first one."""
+    global params, cfg, this_os
+
+    profile, sampled = None, False
+    if params["profile-python"] and get_launch_plan(exploit)[1]:
+        fd, path = tempfile.mkstemp(prefix="sploit-profile-", dir=get_temporary_dir())
+        os.close(fd)
+        args, sampled = profiler_command(exploit, args, path)
+        profile = (path, sampled)
+
+    start = time()
+    first_flag = None
+    output = []
+    run_flags = []
+    proc = Popen(
+        args,
+        stdin=None if stdin is None else PIPE,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        env=env,
+        # in its own process group, so that a timeout also kills its children
+        start_new_session=True,
+    )
+
+    def read_output():
+        nonlocal first_flag
+        # the output not searched yet, with what the lookbehinds need before it
+        pending, pos = bytearray(), 0
+        context = cfg["flagMatcher"]["context"]
+        for line in proc.stdout:
+            if sampled and line.startswith(b"py-spy> "):
+                continue
+            output.append(line)
+            pending += line
+            found, pos = find_flags(pending, pos, final=False)
+            if found and first_flag is None:
+                first_flag = time() - start
+            run_flags.extend(found)
+            if pos > context:
+                del pending[: pos - context]
+                pos = context
+        found, _ = find_flags(pending, pos)
+        if found and first_flag is None:
+            first_flag = time() - start
+        run_flags.extend(found)
+
+    def write_input():
+        try:
+            proc.stdin.write(stdin)
+            proc.stdin.close()
+        except OSError:
+            # the exploit doesn't read it
+            pass
+
+    threads = [Thread(target=read_output, daemon=True)]
+    if stdin is not None:
+        threads.append(Thread(target=write_input, daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        proc.wait(timeout)
+    except TimeoutExpired:
+        if this_os == "windows":
+            proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+        raise
+    finally:
+        proc.wait()
+        # a child that escaped the process group could keep the output open
+        for thread in threads:
+            thread.join(PROFILE_JOIN_TIMEOUT)
+        if profile is not None:
+            collect_profile(exploit_name(exploit), *profile)
+    # py-spy doesn't pass on the exit status of the exploit, and can fail on its own
+    if proc.returncode != 0 and not sampled:
+        raise CalledProcessError(proc.returncode, args)
+    return b"".join(output), run_flags, first_flag
+
+
+def record_timing(
+    name: str,
+    team: str,
+    status: str,
+    wall_time: float,
+    first_flag_time: float | None,
+    output_size: int,
+    flags: int,
+):
+    global wave_timings
+
+    with profile_lock:
+        wave_timings.append(
+            {
+                "exploit": name,
+                "team": team,
+                "status": status,
+                "wallTime": wall_time,
+                "firstFlagTime": first_flag_time,
+                "outputSize": output_size,
+                "flags": flags,
+            }
+        )
+
+
+def print_profile() -> list[dict]:
+    global wave_timings, hotspots
+
+    with profile_lock:
+        timings, wave_timings = wave_timings, []
+        functions, hotspots = hotspots, {}
+    if len(timings) == 0:
+        return timings
+
+    totals = {}
+    for timing in timings:
+        totals[timing["exploit"]] = (
+            totals.get(timing["exploit"], 0) + timing["wallTime"]
+        )
+    for name, total in sorted(totals.items(), key=lambda x: x[1], reverse=True):
+        wprint(highlight(f"{name}: took {total:.2f}s of runner time", CYAN))
+
+    wprint(
+        f"{'EXPLOIT':<20} {'TEAM':<16} {'TIME':>8} {'1ST FLAG':>8} "
+        f"{'STATUS':<8} {'OUTPUT':>8} {'FLAGS':>6}"
+    )
+    slowest = sorted(timings, key=lambda x: x["wallTime"], reverse=True)
+    for timing in slowest[:PROFILE_ROWS]:
+        first_flag = timing["firstFlagTime"]
+        first_flag = "-" if first_flag is None else f"{first_flag:.2f}s"
+        wprint(
+            f"{timing['exploit'][:20]:<20} {timing['team'][:16]:<16} "
+            f"{timing['wallTime']:>7.2f}s {first_flag:>8} {timing['status']:<8} "
+            f"{timing['outputSize']:>8} {timing['flags']:>6}"
+        )
+
+    for name, seconds_by_function in functions.items():
+        hottest = sorted(seconds_by_function.items(), key=lambda x: x[1], reverse=True)
+        wprint(highlight(f"{name}: hottest functions across all teams", CYAN))
+        for function, seconds in hottest[:PROFILE_ROWS]:
+            if seconds < 0.01:
+                break
+            wprint(f"{seconds:>9.2f}s {function}")
+    return timings
+
+
+def send_timings(session: Session, timings: list[dict]):
+    global params
+
+    if len(timings) == 0:
+        return
+    try:
+        res = session.post(
+            url_for("/api/timings"),
+            json={"runner": params["runner"], "timings": timings},
+            timeout=10,
+        )
+        if res.status_code != 200:
+            wprint(highlight(f"Could not send timings ({res.status_code})", YELLOW))
+    except ConnectionError:
+        wprint(highlight("Could not send timings", YELLOW))
+
+
+def run_exploit(exploit: str, team: str) -> list[dict[str, str | float]] | None:
+    global params, cfg, attack_data
+
+    name = exploit_name(exploit)
     timeout = params["timeout"] if params["timeout"] > 1 else 1
-    # FIXME: Do NOT run all exploits with python3 by default. Check whether the file is a binary
-    #        or a script and either use the correct interpreter or refuse to run the file and
-    #        exit with an error.
-    args = ["python3", exploit, team]
+    team_data = attack_data.get("teams", {}).get(team, "{}")
+    env = {**os.environ, "ATTACK_DATA": team_data}
+    stdin = team_data.encode() if params["attack-data-stdin"] else None
 
+    status, output, first_flag, run_flags = "ok", b"", None, []
+    start = time()
     try:
-        output = run_process(
-            args, capture_output=True, timeout=timeout, check=True
-        ).stdout.decode()
-        run_flags = flag_format.findall(output)
+        args = [*get_launch_plan(exploit)[0], team]
+        if params["profile"]:
+            output, found, first_flag = run_profiled(exploit, args, timeout, env, stdin)
+        else:
+            output = run_process(
+                args,
+                capture_output=True,
+                timeout=timeout,
+                check=True,
+                env=env,
+                input=stdin,
+            ).stdout
+            found, _ = find_flags(output)
+        run_flags = [x.decode(errors="replace") for x in found]
         if len(run_flags) == 0:
-            wprint(highlight(f"Got no flags for team {team}", MAGENTA))
+            wprint(highlight(f"{name}: got no flags for team {team}", MAGENTA))
         else:
-            if failure_counters[team] > failure_threshold:
-                failure_counters[team] = failure_threshold  # give it another chance
-            elif failure_counters[team] > 0:
-                failure_counters[team] -= 1
-            wprint(highlight(f"Got {len(run_flags)} flags from team {team}", GREEN))
+            if is_rejected(name, team):
+                wprint(
+                    highlight(f"{name}: flags from team {team} are rejected", MAGENTA)
+                )
+                record_result(exploit, team, False)
+            else:
+                record_result(exploit, team, True)
+            wprint(
+                highlight(f"{name}: got {len(run_flags)} flags from team {team}", GREEN)
+            )
             ts = time()
-            return list(map(lambda x: {"flag": x, "ts": ts}, run_flags))
+            return list(map(lambda x: {"flag": x, "ts": ts, "team": team}, run_flags))
     except CalledProcessError:
-        wprint(highlight(f"Exploit crashed on team {team}!", RED))
+        status = "crash"
+        wprint(highlight(f"{name}: exploit crashed on team {team}!", RED))
     except TimeoutExpired:
-        wprint(highlight(f"Exploit timed-out on team {team}!", YELLOW))
-    if failure_counters[team] < params["max-failures"]:
-        failure_counters[team] += 1
+        status = "timeout"
+        wprint(highlight(f"{name}: exploit timed-out on team {team}!", YELLOW))
+    except (OSError, ValueError) as exc:
+        status = "error"
+        wprint(highlight(f"{name}: could not run exploit on team {team}: {exc}", RED))
+    finally:
+        if params["profile"]:
+            wall_time = time() - start
+            size = len(output)
+            record_timing(
+                name, team, status, wall_time, first_flag, size, len(run_flags)
+            )
+    record_result(exploit, team, False)
     return None
 
 
-def get_attack_data():
-    global cfg
+def get_attack_data(session: Session):
+    global attack_data, cfg
+
+    headers = {}
+    if etag := attack_data.get("etag"):
+        headers["If-None-Match"] = f'"{etag}"'
+    try:
+        res = session.get(url_for("/api/attack"), headers=headers, timeout=10)
+        if res.status_code == 304:
+            return
+        elif res.status_code == 501:
+            if attack_data.get("enabled", True):
+                wprint(highlight("The server does not provide attack data", YELLOW))
+            attack_data = {"enabled": False}
+            return
+        elif res.status_code != 200:
+            wprint(highlight(f"Could not get attack data ({res.status_code})", YELLOW))
+            return
+        data = res.json()
+    except ConnectionError:
+        wprint(highlight("Could not get attack data, using the old one", YELLOW))
+        return
+    except JSONDecodeError:
+        wprint(highlight("Could not decode attack data, using the old one", YELLOW))
+        return
 
-    attack_data_url = params["attack_data_url"]
-    if not attack_data_url:
-        wprint(highlight(f"No attack data url provided", YELLOW))
+    # slice the data once per tick, instead of once per exploit run
+    teams = {}
+    for team in cfg["teams"]:
+        if isinstance(data, dict) and team in data:
+            team_data = data[team]
+        elif isinstance(data, dict):
+            team_data = {
+                service: entries[team]
+                for service, entries in data.items()
+                if isinstance(entries, dict) and team in entries
+            }
+        else:
+            team_data = {}
+        teams[team] = json.dumps(team_data)
+    attack_data = {
+        "etag": res.headers.get("ETag", "").strip('"'),
+        "tick": res.headers.get("X-Farm-Tick"),
+        "teams": teams,
+    }
+    wprint(f"Got new attack data for tick {attack_data['tick']}")
+
+
+def post_retrying(session: Session, path: str, data=None):
+    """Posts to the server, retrying while it is busy or unreachable. Returns None if
+    it never answered."""
+    for attempt in range(LEASE_ATTEMPTS):
+        delay = min(2**attempt, LEASE_MAX_DELAY)
+        try:
+            res = session.post(url_for(path), json=data, timeout=10)
+            if res.status_code not in (429, 503):
+                return res
+            # the server is busy, and says when to come back
+            try:
+                delay = min(float(res.headers["Retry-After"]), LEASE_MAX_DELAY)
+            except (KeyError, ValueError):
+                pass
+        # timeouts too, they are not connection errors
+        except RequestException:
+            pass
+        if attempt < LEASE_ATTEMPTS - 1:
+            sleep(delay)
+    return None
+
+
+def lease_jobs(
+    session: Session, exploit: str, count: int
+) -> tuple[str | None, list[str]] | None:
+    global params, leases
+
+    name = exploit_name(exploit)
+    res = post_retrying(
+        session,
+        f"/api/jobs/{name}",
+        {"runner": params["runner"], "count": count},
+    )
+    if res is None:
+        wprint(
+            highlight(f"{name}: could not get jobs, the server is busy or down", YELLOW)
+        )
+        return None
+    if res.status_code != 200:
+        wprint(highlight(f"{name}: could not get jobs ({res.status_code})", YELLOW))
         return None
-    if not (attack_data_url.startswith("http") and "://" in attack_data_url):
-        wprint(highlight(f"Attack data url not supported! {attack_data_url}", RED))
+    try:
+        data = res.json()
+        if data["lease"] is not None:
+            with leases_lock:
+                leases[data["lease"]] = len(data["teams"])
+        return data["lease"], data["teams"]
+    except (JSONDecodeError, KeyError, TypeError):
+        wprint(highlight(f"{name}: could not get jobs from the server", YELLOW))
         return None
 
-    # TODO finish implementing this
 
+def complete_jobs(session: Session, lease: str, results: dict[str, str]):
+    global leases
 
-def compute_n_workers(n_workers: int, deadline: float, wave_time: float) -> int:
-    global cfg
+    # the lease is renewed until the server knows, or else the jobs would expire and
+    # be given to another runner
+    res = post_retrying(
+        session,
+        f"/api/leases/{lease}/complete",
+        [{"team": team, "result": result} for team, result in results.items()],
+    )
+    with leases_lock:
+        if (remaining := leases.get(lease, 0) - len(results)) > 0:
+            leases[lease] = remaining
+        else:
+            leases.pop(lease, None)
+    try:
+        if res is None or res.status_code != 200:
+            wprint(highlight("Could not report the results of the jobs", YELLOW))
+        elif res.json()["completed"] < len(results):
+            wprint(
+                highlight("Some jobs took too long and were given to others", YELLOW)
+            )
+    except (JSONDecodeError, KeyError, TypeError):
+        wprint(highlight("Could not report the results of the jobs", YELLOW))
 
-    teams = cfg["teams"]
 
+def renew_leases(session: Session):
+    global leases, cfg
+
+    # renew well before the leases expire, a late renewal would be useless
+    while True:
+        sleep(cfg.get("jobLease", 30) / 3)
+        with leases_lock:
+            tokens = list(leases)
+        for lease in tokens:
+            try:
+                res = session.post(url_for(f"/api/leases/{lease}/renew"), timeout=5)
+                if res.status_code == 409:
+                    with leases_lock:
+                        leases.pop(lease, None)
+            except RequestException:
+                # the next renewal is early enough
+                pass
+
+
+def compute_n_workers(
+    n_workers: int, deadline: float, wave_time: float, n_jobs: int
+) -> int:
     wave_time = math.ceil(wave_time)
-    teams_per_worker = math.ceil(len(teams) / n_workers)
-    time_per_team = wave_time / teams_per_worker
-    n_workers = math.ceil((time_per_team * len(teams)) / deadline)
+    jobs_per_worker = math.ceil(n_jobs / n_workers)
+    time_per_job = wave_time / jobs_per_worker
+    n_workers = max(1, math.ceil((time_per_job * n_jobs) / deadline))
     if n_workers > os.cpu_count():
         n_workers = os.cpu_count()
-    expected_time = (time_per_team * len(teams)) / n_workers
+    expected_time = (time_per_job * n_jobs) / n_workers
 
     wprint(
-        f"{teams_per_worker = }, {time_per_team = :.2f}s, {n_workers = }, {expected_time = :.2f}s"
+        f"{jobs_per_worker = }, {time_per_job = :.2f}s, {n_workers = }, {expected_time = :.2f}s"
     )
 
     return n_workers
 
 
-def run_exploit_on_teams(n_workers: int) -> (float, list[dict[str, str | float]]):
-    global cfg
+def run_exploits_on_teams(
+    session: Session, n_workers: int
+) -> (dict[str, int], dict[str, int], dict[str, list[dict[str, str | float]]]):
+    global cfg, exploits, params
+
+    # every exploit gets its own queue of teams, and free workers always pick a job from the
+    # exploit with the least running jobs, so that a slow exploit can't starve the others
+    lock = Lock()
+    # notified whenever a lease is over, for the workers waiting for its jobs
+    leased = Condition(lock)
+    queues = {exploit: [] for exploit in exploits}
+    skipped = {exploit_name(exploit): 0 for exploit in exploits}
+    # exploits that have no more teams to be attacked in this wave
+    drained = set()
+    # exploits whose jobs are being leased by a worker
+    leasing = set()
+    # exploits whose jobs could not be leased, even after retrying
+    failed = set()
+
+    def select_teams(exploit: str, teams: list[str], lease: str | None) -> list[str]:
+        attacked = [x for x in teams if should_attack(exploit, x)]
+        if lease is not None and len(attacked) < len(teams):
+            complete_jobs(
+                session, lease, {x: "skipped" for x in teams if x not in attacked}
+            )
+        # teams are popped from the end, so the most reliable ones are attacked first
+        attacked.sort(key=lambda x: get_failures(exploit, x), reverse=True)
+        return attacked
+
+    def fill_queue(
+        exploit: str, teams: list[str], attacked: list[str], lease: str | None
+    ):
+        skipped[exploit_name(exploit)] += len(teams) - len(attacked)
+        queues[exploit] = [(x, lease) for x in attacked] + queues[exploit]
+
+    if not params["distributed"]:
+        for exploit in exploits:
+            fill_queue(
+                exploit, cfg["teams"], select_teams(exploit, cfg["teams"], None), None
+            )
+            drained.add(exploit)
+    running = {exploit: 0 for exploit in exploits}
+    fails = {exploit_name(exploit): 0 for exploit in exploits}
+    wave_flags = {exploit_name(exploit): [] for exploit in exploits}
+
+    def next_job() -> tuple[str, str, str | None] | None:
+        with lock:
+            while True:
+                if pending := [x for x in queues if len(queues[x]) > 0]:
+                    exploit = min(pending, key=lambda x: running[x])
+                    running[exploit] += 1
+                    return exploit, *queues[exploit].pop()
+                leasable = [x for x in queues if x not in drained | leasing | failed]
+                if not leasable:
+                    if not leasing:
+                        return None
+                    # another worker is leasing jobs, which could be for this one too
+                    leased.wait()
+                    continue
+                # lease a few jobs at a time, so that faster machines end up with more
+                exploit = min(leasable, key=lambda x: running[x])
+                leasing.add(exploit)
+                # the other workers must be able to pick their jobs in the meantime
+                lock.release()
+                try:
+                    if (jobs := lease_jobs(session, exploit, n_workers)) is not None:
+                        lease, teams = jobs
+                        attacked = select_teams(exploit, teams, lease)
+                finally:
+                    lock.acquire()
+                    leasing.discard(exploit)
+                    leased.notify_all()
+                if jobs is None:
+                    # the server kept failing, the next wave will ask again
+                    failed.add(exploit)
+                    continue
+                # the other runners got the rest of the teams
+                if len(teams) < n_workers:
+                    drained.add(exploit)
+                fill_queue(exploit, teams, attacked, lease)
+
+    def work():
+        while job := next_job():
+            exploit, team, lease = job
+            run_flags = run_exploit(exploit, team)
+            if lease is not None:
+                result = "success" if run_flags else "failure"
+                complete_jobs(session, lease, {team: result})
+            with lock:
+                running[exploit] -= 1
+                if run_flags:
+                    wave_flags[exploit_name(exploit)].extend(run_flags)
+                else:
+                    fails[exploit_name(exploit)] += 1
 
-    fails = 0
-    teams = cfg["teams"]
-    wave_flags = []
     with ThreadPoolExecutor(max_workers=n_workers) as executor:
-        this_flags = executor.map(run_exploit, teams)
-        for run_flags in this_flags:
-            if run_flags:
-                wave_flags.extend(run_flags)
-            else:
-                fails += 1
-    return fails, wave_flags
-
+        for future in [executor.submit(work) for _ in range(n_workers)]:
+            future.result()
+    return fails, skipped, wave_flags
 
-def send_flags(session: Session, flags: list[str]) -> bool:
-    global params
 
+def send_flags(session: Session, name: str, flags: list[str]) -> bool:
     try:
-        exploit = params["exploit"]
-        exploit_name, _ = os.path.basename(exploit).split(".", 1)
-        res = session.post(
-            url_for(f"/api/flags/{exploit_name}"), json=flags, timeout=10
-        )
+        res = session.post(url_for(f"/api/flags/{name}"), json=flags, timeout=10)
         if res.status_code == 200:
             return True
-        wprint(highlight("Could not send flags, am I not authenticated?", YELLOW))
+        elif res.status_code in (429, 503):
+            wprint(
+                highlight("The server is busy, I will send the flags later.", YELLOW)
+            )
+        else:
+            wprint(highlight("Could not send flags, am I not authenticated?", YELLOW))
     except ConnectionError:
         wprint(highlight("Could not send flags, I will send them later.", YELLOW))
     return False
 
 
 def main():
-    global wave, params
+    global wave, params, exploits
 
     parse_args()
     set_proc_name("start_sploit")
-    check_exploit()
+    for exploit in filter(lambda x: not os.path.isdir(x), params["exploits"]):
+        if not check_exploit(exploit):
+            exit(-1)
+        exploits.append(exploit)
     session = authenticate()
     print("Retrieving config...")
     get_config(session)
+    sync_clock(session)
+    load_backoff()
+    load_seen()
     if params["fake-timestamps"]:
         launch_hfi(session)
 
+    if params["distributed"]:
+        Thread(target=renew_leases, args=(session,), daemon=True).start()
+
     n_workers = os.cpu_count()
     deadline = cfg["tickDuration"] * 0.5
 
-    flags = []
+    # flags that still have to be sent, indexed by exploit name
+    flags = {}
     try:
         while True:
             print()
-            wprint(f"Beginning new run...")
+            refresh_exploits()
+            wprint(f"Beginning new run with {len(exploits)} exploits...")
             start = time()
-            # TODO finish this
-            # attack_data = get_attack_data()
-            fails, wave_flags = run_exploit_on_teams(n_workers)
-            wprint(f"Run finished, got {len(wave_flags)} flags")
-            wprint(f"Exploit failed on {fails} teams")
-            if len(wave_flags) == 0:
-                wprint(highlight(f"Got 0 flags, something's broken!", YELLOW))
+            wave_tick = get_tick(server_time())
+            get_attack_data(session)
+            if params["server-stats"]:
+                get_server_stats(session)
+            fails, skipped, wave_flags = run_exploits_on_teams(session, n_workers)
+            save_backoff()
+            for name, run_flags in wave_flags.items():
+                new_flags = unseen_flags(run_flags)
+                wprint(
+                    f"{name}: run finished, got {len(run_flags)} flags "
+                    f"({len(new_flags)} new)"
+                )
+                wprint(f"{name}: exploit failed on {fails[name]} teams")
+                if skipped[name] > 0:
+                    wprint(f"{name}: skipped {skipped[name]} teams (too many failures)")
+                # with --distributed the other machines could have attacked every team
+                if len(run_flags) == 0 and fails[name] > 0:
+                    wprint(
+                        highlight(f"{name}: got 0 flags, something's broken!", YELLOW)
+                    )
+                flags.setdefault(name, []).extend(new_flags)
             # send flags
-            flags.extend(wave_flags)
-            if send_flags(session, flags):
-                flags.clear()  # only clear the flags array if we managed to send all the flags
+            for name in [x for x in flags if len(flags[x]) > 0]:
+                # flags that could not be sent before could have been stolen again
+                new_flags = unseen_flags(flags[name])
+                # only clear the flags array if we managed to send all the flags
+                if len(new_flags) == 0 or send_flags(session, name, new_flags):
+                    mark_seen(new_flags)
+                    flags[name].clear()
+            save_seen()
+            if params["profile"]:
+                send_timings(session, print_profile())
             # end wave and recompute parameters
             wave_time = time() - start
             wprint(f"Took {wave_time:.2f} seconds, recomputing parameters...")
-            n_workers = compute_n_workers(n_workers, deadline, wave_time)
+            n_jobs = max(1, len(exploits) * len(cfg["teams"]))
+            n_workers = compute_n_workers(n_workers, deadline, wave_time, n_jobs)
             # wait for next the  wave to start
-            wait_time = deadline - wave_time
+            sync_clock(session)
+            wait_time = get_wait_time(wave_tick, wave_time, deadline)
             if wait_time > 0:
                 wprint(f"Sleeping for {wait_time:.2f}s")
                 sleep(wait_time)
             else:
-                wprint(highlight("Your exploit is very slow! Speed it up!", YELLOW))
+                wprint(highlight("Your exploits are very slow! Speed them up!", YELLOW))
             get_config(session)  # refresh config
             wave += 1
     except KeyboardInterrupt:
@@ -0,0 +1,182 @@
+import math
+import metrics
+
+from typing import Callable
+from flask import request, session, g
+from threading import Condition, Lock
+from werkzeug import Response
+from config import Config
+from time import perf_counter, monotonic
+
+
+# Requests are split into lanes, each with its own number of concurrent requests.
+# Every request is served by a thread of its lane, so the server never runs more
+# threads than the sum of the limits and dashboard queries can't take the threads
+# needed to receive the flags. The lanes of the clients also have threads for a few
+# requests waiting for a slot, so that a burst of flags is queued rather than turned
+# away, while the dashboard is turned away at once.
+INGEST = "ingest"
+CRITICAL = "critical"
+# The attack data, which can wait for the game system at the start of a tick
+ATTACK = "attack"
+DASHBOARD = "dashboard"
+
+_TIMEOUT = float(Config.admission_timeout)
+_QUEUE = int(Config.admission_queue)
+_SESSION_RATE = float(Config.session_rate)
+# Rate limited sessions can still send this many requests at once
+_SESSION_BURST = 2 * _SESSION_RATE
+# Buckets of the sessions idle for this long are dropped
+_SESSION_IDLE = 60
+
+_WAIT_TIME = metrics.Histogram(
+    "farm_admission_wait_seconds",
+    "Time spent by the requests waiting for a free slot in their lane",
+    ("lane",),
+)
+_REJECTED = metrics.Counter(
+    "farm_admission_rejected_total", "Requests turned away", ("lane", "reason")
+)
+
+
+class Lane(object):
+    def __init__(self, name: str, limit: int, queue: int = 0, timeout: float = 0):
+        self.name = name
+        self.limit = limit
+        # How many requests can wait for a slot, and for how long
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = Condition()
+
+    def acquire(self) -> bool:
+        start = perf_counter()
+        with self._cond:
+            if self.active >= self.limit and self.waiting >= self.queue:
+                return False
+            self.waiting += 1
+            admitted = self._cond.wait_for(
+                lambda: self.active < self.limit, self.timeout
+            )
+            self.waiting -= 1
+            if admitted:
+                self.active += 1
+        _WAIT_TIME.observe(perf_counter() - start, self.name)
+        return admitted
+
+    def release(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+_lanes = {
+    INGEST: Lane(INGEST, int(Config.ingest_limit), _QUEUE, _TIMEOUT),
+    CRITICAL: Lane(CRITICAL, int(Config.critical_limit), _QUEUE, _TIMEOUT),
+    ATTACK: Lane(ATTACK, int(Config.critical_limit), _QUEUE, _TIMEOUT),
+    DASHBOARD: Lane(DASHBOARD, int(Config.dashboard_limit)),
+}
+# The lane of every endpoint. The others (pages, static files) are quick to serve
+# and a page needs all of them, so they are not limited and get a few more threads.
+_endpoints: dict[str, str] = {}
+# Endpoints whose requests are never rate limited
+_unlimited: set[str] = set()
+_PAGE_THREADS = 2
+
+THREADS = sum(x.limit + x.queue for x in _lanes.values()) + _PAGE_THREADS
+
+metrics.Gauge(
+    "farm_admission_active_requests",
+    "Requests being served in every lane",
+    lambda: {(x.name,): x.active for x in _lanes.values()},
+    ("lane",),
+)
+metrics.Gauge(
+    "farm_admission_waiting_requests",
+    "Requests waiting for a free slot in every lane",
+    lambda: {(x.name,): x.waiting for x in _lanes.values()},
+    ("lane",),
+)
+
+
+class _Buckets(object):
+    """Token buckets refilled at `rate` tokens per second, one for every key."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._lock = Lock()
+        # key -> [tokens, last refill]
+        self._buckets: dict[str, list[float]] = {}
+        self._last_cleanup = monotonic()
+
+    def take(self, key: str) -> float:
+        """Takes a token, returning 0 if there was one, or else how many seconds to
+        wait for the next one."""
+        now = monotonic()
+        with self._lock:
+            if now - self._last_cleanup > _SESSION_IDLE:
+                self._cleanup(now)
+            if (bucket := self._buckets.get(key)) is None:
+                bucket = self._buckets[key] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return (1 - bucket[0]) / self.rate
+            bucket[0] -= 1
+            return 0
+
+    def _cleanup(self, now: float) -> None:
+        self._buckets = {
+            k: v for k, v in self._buckets.items() if now - v[1] <= _SESSION_IDLE
+        }
+        self._last_cleanup = now
+
+
+_session_buckets = {
+    CRITICAL: _Buckets(_SESSION_RATE, _SESSION_BURST),
+    DASHBOARD: _Buckets(_SESSION_RATE, _SESSION_BURST),
+}
+
+
+def lane(name: str, rate_limited: bool = True) -> Callable[[Callable], Callable]:
+    """Puts the requests of an endpoint in a lane."""
+
+    def decorator(function: Callable) -> Callable:
+        _endpoints[function.__name__] = name
+        if not rate_limited:
+            _unlimited.add(function.__name__)
+        return function
+
+    return decorator
+
+
+def _retry_after(status: int, seconds: float) -> Response:
+    return Response(status=status, headers={"Retry-After": str(math.ceil(seconds))})
+
+
+def admit() -> Response | None:
+    """Takes a slot in the lane of the current request, or returns the response to
+    turn it away with."""
+    endpoint = request.endpoint or ""
+    if (name := _endpoints.get(endpoint)) is None:
+        return None
+    current = _lanes[name]
+    # Flags are never rate limited, they must get in no matter what
+    buckets = _session_buckets.get(current.name)
+    if buckets is not None and endpoint not in _unlimited:
+        key = session.get("id") or request.remote_addr or ""
+        if (wait := buckets.take(key)) > 0:
+            _REJECTED.inc(current.name, "rate_limited")
+            return _retry_after(429, wait)
+    if not current.acquire():
+        _REJECTED.inc(current.name, "saturated")
+        return _retry_after(503, 1)
+    g.lane = current
+    return None
+
+
+def release() -> None:
+    if (current := g.pop("lane", None)) is not None:
+        current.release()
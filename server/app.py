@@ -1,29 +1,50 @@
 import session
 import flags
+import attack
+import jobs
+import timings
+import assets
+import admission
+import replication
+import ticks
+import flagmatch
+import metrics
 import log
 
 from typing import Callable
 from flask import Flask
-from flask import request
-from flask import send_from_directory, redirect, abort, jsonify
+from flask import request, g
+from flask import redirect, abort, jsonify
 from werkzeug import Response
 from config import Config
 from database import db
+from timeutils import precise_time
+from time import perf_counter
 
 
-app = Flask(__name__)
+# Static files are served from memory by the assets module
+app = Flask(__name__, static_folder=None)
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{Config.database}"
 app.secret_key = Config.secret_key
 
+_access_log = log.RateLimiter(int(Config.access_log_rate))
+
+_REQUEST_LATENCY = metrics.Histogram(
+    "farm_http_request_seconds", "Latency of the HTTP requests", ("method", "route")
+)
+_RESPONSES = metrics.Counter(
+    "farm_http_responses_total", "HTTP responses", ("method", "route", "status")
+)
+
 db.init_app(app)
 
 
 def page(name: str) -> Response:
-    return send_from_directory("static/html", f"{name}.html")
+    return assets.serve(f"html/{name}.html") or abort(404)
 
 
 def file(name: str) -> Response:
-    return send_from_directory("static/files", name, as_attachment=True)
+    return assets.serve(f"files/{name}", attachment=True) or abort(404)
 
 
 def success() -> Response:
@@ -60,7 +81,13 @@ def script() -> Response:
     return file("start_sploit.py")
 
 
+@app.get("/static/<path:path>")
+def static_file(path: str) -> Response:
+    return assets.serve_url(path) or abort(404)
+
+
 @app.post("/api/auth")
+@admission.lane(admission.CRITICAL)
 def api_auth() -> Response:
     if (
         request.is_json
@@ -74,6 +101,7 @@ def api_auth() -> Response:
 
 
 @app.route("/api/flags/<string:exploit>", methods=["POST", "PUT"])
+@admission.lane(admission.INGEST)
 @require_auth
 def api_put_flags(exploit: str) -> Response:
     if not request.is_json or not isinstance(request.json, list):
@@ -83,6 +111,7 @@ def api_put_flags(exploit: str) -> Response:
 
 
 @app.get("/api/flags")
+@admission.lane(admission.DASHBOARD)
 @require_auth
 def api_get_flags() -> Response:
     offset = int(request.args.get("start", 0))
@@ -92,31 +121,187 @@ def api_get_flags() -> Response:
     return jsonify(flags.query(offset, count))
 
 
+@app.get("/api/stats/teams/<string:exploit>")
+@admission.lane(admission.DASHBOARD)
+@require_auth
+def api_team_stats(exploit: str) -> Response:
+    return jsonify(flags.team_stats(exploit))
+
+
+@app.get("/api/timings")
+@admission.lane(admission.DASHBOARD)
+@require_auth
+def api_get_timings() -> Response:
+    count = request.args.get("count", 20, type=int)
+    if count > 100:
+        abort(400)
+    return jsonify(timings.report(count))
+
+
+@app.post("/api/timings")
+@admission.lane(admission.CRITICAL)
+@require_auth
+def api_put_timings() -> Response:
+    if (
+        not request.is_json
+        or not isinstance(body := request.json, dict)
+        or not isinstance(runner := body.get("runner"), str)
+        or not isinstance(entries := body.get("timings"), list)
+        or not all(timings.valid_timing(x) for x in entries)
+    ):
+        abort(400)
+    timings.record(runner, entries)
+    return success()
+
+
+# The requests about jobs are not rate limited: a runner that can't renew or complete
+# its lease would have its jobs given to another runner, which attacks the same teams
+@app.post("/api/jobs/<string:exploit>")
+@admission.lane(admission.CRITICAL, rate_limited=False)
+@require_auth
+def api_lease_jobs(exploit: str) -> Response:
+    if (
+        not request.is_json
+        or not isinstance(body := request.json, dict)
+        or not isinstance(runner := body.get("runner"), str)
+        or not isinstance(count := body.get("count"), int)
+        or count <= 0
+    ):
+        abort(400)
+    return jsonify(jobs.lease(exploit, runner, count))
+
+
+@app.post("/api/leases/<string:lease>/renew")
+@admission.lane(admission.CRITICAL, rate_limited=False)
+@require_auth
+def api_renew_lease(lease: str) -> Response:
+    # The jobs were handed out to somebody else
+    return success() if jobs.renew(lease) else abort(409)
+
+
+@app.post("/api/leases/<string:lease>/complete")
+@admission.lane(admission.CRITICAL, rate_limited=False)
+@require_auth
+def api_complete_jobs(lease: str) -> Response:
+    if not request.is_json or not isinstance(body := request.json, list):
+        abort(400)
+    results = []
+    for entry in body:
+        if (
+            not isinstance(entry, dict)
+            or not isinstance(team := entry.get("team"), str)
+            or not jobs.valid_result(result := entry.get("result"))
+        ):
+            abort(400)
+        results.append((team, result))
+    return jsonify({"completed": jobs.complete(lease, results)})
+
+
 @app.get("/api/config")
+@admission.lane(admission.CRITICAL)
 @require_auth
 def api_config() -> Response:
     config = {
         "flagFormat": Config.flag_format,
+        "flagPrefilter": flagmatch.PREFILTER,
         "flagLifetime": Config.flag_lifetime,
         "tickDuration": Config.tick_duration,
+        "tickStart": ticks.TICK_START or None,
+        "serverTime": precise_time(),
         "teams": Config.teams,
+        "jobLease": jobs.LEASE_DURATION,
     }
     return jsonify(config)
 
 
+@app.get("/api/time")
+@admission.lane(admission.CRITICAL)
+@require_auth
+def api_time() -> Response:
+    return jsonify({"time": precise_time()})
+
+
 @app.get("/api/attack")
+@admission.lane(admission.ATTACK)
 @require_auth
 def api_attack() -> Response:
-    # TODO: Implement attack data caching
-    abort(501)
+    if not attack.enabled():
+        abort(501)
+    if (data := attack.get()) is None:
+        abort(503)
+    response = Response(data.body, mimetype="application/json")
+    response.set_etag(data.etag)
+    response.headers["X-Farm-Tick"] = str(data.tick)
+    return response.make_conditional(request)
+
+
+def check_basic_auth() -> bool:
+    # Scrapers and other farms can't log in, so they can use HTTP basic auth with the
+    # farm password
+    return session.check() or bool(
+        (auth := request.authorization)
+        and auth.password
+        and session.check_password(auth.password)
+    )
+
+
+def unauthorized() -> Response:
+    return Response(status=401, headers={"WWW-Authenticate": "Basic"})
+
+
+@app.get("/metrics")
+@admission.lane(admission.CRITICAL)
+def metrics_page() -> Response:
+    if not check_basic_auth():
+        return unauthorized()
+    return Response(metrics.expose(), mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/api/replication/changes")
+@admission.lane(admission.CRITICAL)
+def api_replication_changes() -> Response:
+    if not check_basic_auth():
+        return unauthorized()
+    since = request.args.get("since", 0, type=int)
+    limit = min(request.args.get("limit", 100, type=int), replication.CHANGES_LIMIT)
+    epoch, changes = flags.changes(since, limit)
+    return jsonify({"node": replication.NODE_ID, "epoch": epoch, "changes": changes})
+
+
+def _access_message(response: Response, elapsed: float) -> str:
+    path = request.full_path.strip("?")
+    return f"{request.method} {path} -> HTTP {response.status} ({elapsed * 1000:.1f}ms)"
 
 
 @app.before_request
 def log_request() -> None:
-    log.info(f"-> {request.method} {request.full_path.strip("?")}")
+    g.start = perf_counter()
+
+
+@app.before_request
+def admit_request() -> Response | None:
+    return admission.admit()
+
+
+@app.teardown_request
+def release_request(_: BaseException | None) -> None:
+    admission.release()
 
 
 @app.after_request
 def log_response(response: Response) -> Response:
-    log.info(f"<- HTTP {response.status}")
+    elapsed = perf_counter() - g.start
+    route = request.url_rule.rule if request.url_rule else "<unknown>"
+    _REQUEST_LATENCY.observe(elapsed, request.method, route)
+    _RESPONSES.inc(request.method, route, str(response.status_code))
+    # Server errors are always logged, everything else is rate limited per route
+    if response.status_code >= 500:
+        log.error(_access_message(response, elapsed))
+    elif log.enabled(log.LEVEL_INFO):
+        allowed, suppressed = _access_log.allow(f"{request.method} {route}")
+        if allowed and suppressed > 0:
+            message = _access_message(response, elapsed)
+            log.info(f"{message} ({suppressed} similar requests not logged)")
+        elif allowed:
+            log.info(_access_message(response, elapsed))
     return response
@@ -0,0 +1,152 @@
+import os
+import gzip
+import log
+import hashlib
+import mimetypes
+
+from flask import request
+from werkzeug import Response
+from config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+_DEV_MODE = bool(Config.dev_mode)
+# Fingerprinted URLs never change content, so browsers can keep them forever
+_IMMUTABLE = "public, max-age=31536000, immutable"
+# Everything else (pages behind the login too) must be revalidated on every use
+_REVALIDATE = "private, no-cache"
+
+type Signature = tuple[tuple[str, int, int], ...]
+
+
+class Asset(object):
+    """A static file, kept in memory along with its compressed versions."""
+
+    def __init__(self, name: str, content: bytes):
+        self.name = name
+        self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.digest = hashlib.sha256(content).hexdigest()[:16]
+        self.encodings = {"identity": content}
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) < len(content):
+            self.encodings["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(content, quality=11)
+            if len(compressed) < len(content):
+                self.encodings["br"] = compressed
+
+    @property
+    def url(self) -> str:
+        stem, extension = os.path.splitext(self.name)
+        return f"/static/{stem}.{self.digest}{extension}"
+
+    def etag(self, encoding: str) -> str:
+        # Every representation needs its own strong ETag
+        return self.digest if encoding == "identity" else f"{self.digest}-{encoding}"
+
+
+class _Cache(object):
+    def __init__(self, signature: Signature):
+        self.signature = signature
+        self.assets: dict[str, Asset] = {}
+        # Fingerprinted URLs, pointing to the name of their asset
+        self.urls: dict[str, str] = {}
+        pages = []
+        for name, _, _ in signature:
+            with open(os.path.join(STATIC_DIR, name), "rb") as f:
+                content = f.read()
+            if name.endswith(".html"):
+                pages.append((name, content))
+            else:
+                self._add(Asset(name, content))
+        # Pages link to the fingerprinted assets, so they are loaded last
+        for name, content in pages:
+            text = content.decode()
+            for asset in list(self.assets.values()):
+                text = text.replace(f'"/static/{asset.name}"', f'"{asset.url}"')
+            self._add(Asset(name, text.encode()))
+
+    def _add(self, asset: Asset) -> None:
+        self.assets[asset.name] = asset
+        self.urls[asset.url] = asset.name
+
+
+def _signature() -> Signature:
+    files = []
+    for directory, _, names in os.walk(STATIC_DIR):
+        for name in names:
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            files.append(
+                (os.path.relpath(path, STATIC_DIR), stat.st_mtime_ns, stat.st_size)
+            )
+    return tuple(sorted(files))
+
+
+def _load() -> _Cache:
+    cache = _Cache(_signature())
+    size = sum(len(x.encodings["identity"]) for x in cache.assets.values())
+    log.info(f"Loaded {len(cache.assets)} static files ({size // 1024} KiB)")
+    return cache
+
+
+_cache = _load()
+
+
+def _current() -> _Cache:
+    global _cache
+
+    if _DEV_MODE:
+        # Pick up edits without restarting, the static files are only a handful
+        try:
+            if _signature() != _cache.signature:
+                _cache = _load()
+        except OSError as e:
+            log.warning(f"Could not reload the static files. {e}")
+    return _cache
+
+
+def _encoding(asset: Asset) -> str:
+    for encoding in ("br", "gzip"):
+        if encoding in asset.encodings and request.accept_encodings[encoding] > 0:
+            return encoding
+    return "identity"
+
+
+def _serve(asset: Asset, cache_control: str, attachment: bool = False) -> Response:
+    encoding = _encoding(asset)
+    etag = asset.etag(encoding)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset.encodings[encoding], mimetype=asset.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        if attachment:
+            filename = os.path.basename(asset.name)
+            response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def serve(name: str, attachment: bool = False) -> Response | None:
+    """Serves a static file by its name, which browsers must revalidate every time."""
+    if (asset := _current().assets.get(name)) is None:
+        return None
+    return _serve(asset, _REVALIDATE, attachment)
+
+
+def serve_url(path: str) -> Response | None:
+    """Serves a static file requested under /static, which is cached for good when the
+    URL is fingerprinted."""
+    cache = _current()
+    if (name := cache.urls.get(f"/static/{path}")) is not None:
+        return _serve(cache.assets[name], _IMMUTABLE)
+    return serve(path)
@@ -0,0 +1,83 @@
+import log
+import ticks
+import requests
+
+from threading import Condition
+from hashlib import sha256
+from config import Config
+from timeutils import time
+
+
+_ATTACK_DATA_URL = str(Config.attack_data_url)
+_TIMEOUT = int(Config.submit_timeout)
+_TEAM_TOKEN = str(Config.team_token)
+# The game system can publish the data of a tick a while after it starts, so it is
+# fetched again this often, and the clients get it with their conditional requests
+_REFRESH_PERIOD = 5
+
+
+class AttackData(object):
+    def __init__(self, tick: int, body: bytes):
+        # The tick in which this data was first fetched
+        self.tick = tick
+        self.body = body
+        self.etag = sha256(body).hexdigest()[:32]
+
+
+_cond = Condition()
+_cached: AttackData | None = None
+_fetching = False
+_last_attempt = 0
+
+
+def _fetch() -> bytes | None:
+    try:
+        response = requests.get(
+            _ATTACK_DATA_URL,
+            headers={"X-Team-Token": _TEAM_TOKEN},
+            timeout=_TIMEOUT,
+        )
+        response.raise_for_status()
+        # Make sure we never cache error pages
+        if not isinstance(response.json(), dict | list):
+            raise TypeError("Unexpected attack data type")
+        return response.content
+    except (TypeError, requests.JSONDecodeError):
+        log.error("Invalid attack data received from the game system")
+    except requests.RequestException as e:
+        log.error(f"Could not get attack data from the game system. {e}")
+    return None
+
+
+def enabled() -> bool:
+    return len(_ATTACK_DATA_URL) > 0
+
+
+def get() -> AttackData | None:
+    global _cached, _fetching, _last_attempt
+
+    tick = ticks.current()
+    # A single request fetches the data at a time. At the start of a tick, the others
+    # wait for it rather than get the data of the previous tick, instead of hammering
+    # the game system with the same request.
+    with _cond:
+        while _fetching:
+            if _cached is not None and _cached.tick == tick:
+                return _cached
+            _cond.wait()
+        if time() - _last_attempt < _REFRESH_PERIOD:
+            return _cached
+        _fetching = True
+        _last_attempt = time()
+    body = None
+    try:
+        body = _fetch()
+    finally:
+        with _cond:
+            _fetching = False
+            # When the game system can't be reached, the stale data is served
+            if body is not None and (_cached is None or body != _cached.body):
+                log.info(f"Fetched attack data for tick {tick} ({len(body)} bytes)")
+                _cached = AttackData(tick, body)
+            _cond.notify_all()
+    return _cached
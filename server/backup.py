@@ -0,0 +1,169 @@
+import os
+import gzip
+import log
+import shutil
+import sqlite3
+import metrics
+
+from time import sleep, perf_counter
+from flask import Flask
+from config import Config
+from database import db, new_epoch
+from timeutils import time
+from datetime import datetime
+
+
+BACKUP_DIR = str(Config.backup_dir)
+_DATABASE = str(Config.database)
+_PERIOD = int(Config.backup_period)
+_KEEP = int(Config.backup_keep)
+_PAGES = int(Config.backup_pages)
+_COMPRESS = bool(Config.backup_compress)
+_PREFIX = "farm-"
+# Time given to the writers between two steps of the copy
+_STEP_SLEEP = 0.005
+# A copy restarts whenever another connection writes to the database, give up on
+# copying it a few pages at a time after this many restarts
+_MAX_RESTARTS = 3
+
+_BACKUP_TIME = metrics.Histogram(
+    "farm_backup_seconds",
+    "Time spent on database backups",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100),
+)
+_last_backup = 0
+metrics.Gauge(
+    "farm_backup_age_seconds",
+    "Time since the last successful backup",
+    lambda: {(): time() - _last_backup} if _last_backup else {},
+)
+
+
+class _Restarted(Exception):
+    pass
+
+
+def _copy(source: sqlite3.Connection, target: sqlite3.Connection) -> None:
+    restarts = 0
+    last_remaining = None
+
+    def progress(_, remaining: int, total: int) -> None:
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > _MAX_RESTARTS:
+                raise _Restarted()
+        last_remaining = remaining
+
+    try:
+        source.backup(target, pages=_PAGES, progress=progress, sleep=_STEP_SLEEP)
+    except _Restarted:
+        # In WAL mode copying everything at once is a single read transaction, which
+        # doesn't block the writers either
+        log.warning("The database changes too often, backing it up in one step")
+        source.backup(target)
+
+
+def _backup_to(path: str) -> None:
+    target = sqlite3.connect(path)
+    try:
+        if _DATABASE == ":memory:":
+            # There is no other way to reach an in-memory database than its connection.
+            # It is never replaced, so it can be given back to the sessions right away:
+            # the copy waits whenever one of them is writing, and writes through the
+            # same connection don't restart it.
+            connection = db.engine.raw_connection()
+            source = connection.driver_connection
+            connection.close()
+            _copy(source, target)
+        else:
+            source = sqlite3.connect(f"file:{_DATABASE}?mode=ro", uri=True)
+            try:
+                _copy(source, target)
+            finally:
+                source.close()
+    finally:
+        target.close()
+
+
+def _compress(path: str) -> str:
+    with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return f"{path}.gz"
+
+
+def _rotate() -> None:
+    backups = sorted(
+        x
+        for x in os.listdir(BACKUP_DIR)
+        if x.startswith(_PREFIX) and (x.endswith(".db") or x.endswith(".db.gz"))
+    )
+    for name in backups[: max(len(backups) - _KEEP, 0)]:
+        os.remove(os.path.join(BACKUP_DIR, name))
+
+
+def run() -> str:
+    global _last_backup
+
+    start = perf_counter()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"{_PREFIX}{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    # Never leave a torn backup behind, only complete files get their final name
+    partial = os.path.join(BACKUP_DIR, f".{name}.part")
+    try:
+        _backup_to(partial)
+        if _COMPRESS:
+            partial = _compress(partial)
+            name += ".gz"
+        path = os.path.join(BACKUP_DIR, name)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    _rotate()
+    _last_backup = time()
+    _BACKUP_TIME.observe(perf_counter() - start)
+    log.info(f"Backed up the database to {path} in {perf_counter() - start:.2f}s")
+    return path
+
+
+def _restore(path: str) -> None:
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+        source = sqlite3.connect(":memory:")
+        source.deserialize(data)
+    else:
+        source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        check = source.execute("PRAGMA integrity_check").fetchone()[0]
+        log.ensure(check == "ok", f"The backup {path} is corrupted: {check}")
+        connection = db.engine.raw_connection()
+        try:
+            source.backup(connection.driver_connection)
+        finally:
+            connection.close()
+    finally:
+        source.close()
+
+
+def restore(path: str) -> None:
+    """Replaces the content of the database with a backup."""
+    try:
+        _restore(path)
+    except (OSError, sqlite3.Error) as e:
+        log.fatal(f"Could not restore the database from {path}. {e}")
+    # The changes made after the backup are gone, and their numbers will be reused
+    new_epoch()
+    log.info(f"Restored the database from {path}")
+
+
+def task(app: Flask) -> None:
+    while True:
+        sleep(_PERIOD)
+        with app.app_context():
+            try:
+                run()
+            except (OSError, sqlite3.Error) as e:
+                log.error(f"Could not back up the database. {e}")
@@ -1,3 +1,5 @@
+import os
+import socket
 import secrets
 import re
 import yaml
@@ -6,6 +8,7 @@ import log
 from typing import Any, cast
 from os import getenv
 from hashlib import sha256
+from datetime import datetime
 
 
 type ConfigValue = int | str | bytes | bool
@@ -26,6 +29,25 @@ class ConfigMeta(type):
         "flag_format": "[A-Z0-9]{31}=",
         "hfi_source": "../hfi",
         "hfi_cache": "../hfi-cache",
+        "log_level": "info",
+        "log_format": "text",
+        "access_log_rate": 10,
+        "web_workers": 1,
+        "tasks_port": 6970,
+        "job_lease": 30,
+        "flag_store": "sqlite",
+        "flag_store_path": "flag-store",
+        "snapshot_period": 300,
+        "replication_period": 2,
+        "backup_period": 600,
+        "backup_keep": 5,
+        "backup_pages": 64,
+        "ingest_limit": 4,
+        "critical_limit": 2,
+        "dashboard_limit": 2,
+        "admission_queue": 16,
+        "admission_timeout": 5,
+        "session_rate": 20,
     }
 
     _yaml_data = None
@@ -82,11 +104,14 @@ class ConfigMeta(type):
     def _getter_secret_key(cls) -> bytes:
         if not (key := cls._get_env("secret_key")):
             log.warning("No secret key provided. Generating a default one...")
-            key = secrets.token_bytes(32)
+            key = secrets.token_hex(32)
             log.info(
                 "You can specify a secret key using the FARM_SECRET_KEY environment variable"
             )
-            return key
+            # Every process of the farm (and every later call) must use the same key,
+            # or they won't be able to read each other's sessions
+            os.environ["FARM_SECRET_KEY"] = key
+            return key.encode("ASCII")
         else:
             return str(key).encode("ASCII")
 
@@ -96,6 +121,55 @@ class ConfigMeta(type):
             log.warning("Using an in-memory database is discouraged!")
         return value
 
+    @classmethod
+    def _getter_attack_data_url(cls) -> str:
+        if value := cls._get_env("attack_data_url") or cls._get_yaml("attack_data_url"):
+            return str(value)
+        # ForcAD serves the attack data on the same host used to submit the flags
+        if str(cls._get_value("system_type")).lower() == "forcad":
+            scheme, _, rest = str(cls._get_value("system_url")).partition("://")
+            return f"{scheme}://{rest.split('/', 1)[0]}/api/client/attack_data"
+        return ""
+
+    @classmethod
+    def _getter_tick_start(cls) -> int:
+        value = cls._get_env("tick_start") or cls._get_yaml("tick_start")
+        if isinstance(value, int) or not value:
+            return value or 0
+        try:
+            # PyYAML already parses dates on its own
+            if not isinstance(value, datetime):
+                value = datetime.fromisoformat(str(value))
+            return int(value.timestamp())
+        except ValueError:
+            log.fatal(f"Invalid tick start '{value}'")
+
+    @classmethod
+    def _getter_peers(cls) -> list[str]:
+        value = cls._get_env("peers") or cls._get_yaml("peers") or []
+        if isinstance(value, str):
+            value = value.split(",")
+        return [str(x).strip() for x in value if str(x).strip()]
+
+    @classmethod
+    def _getter_node_id(cls) -> str:
+        if value := cls._get_env("node_id") or cls._get_yaml("node_id"):
+            return str(value)
+        return f"{socket.gethostname()}:{cls._get_value('port')}"
+
+    @classmethod
+    def _getter_submitter(cls) -> str:
+        return str(cls._get_env("submitter") or cls._get_yaml("submitter") or "")
+
+    @classmethod
+    def _getter_backup_dir(cls) -> str:
+        return str(cls._get_env("backup_dir") or cls._get_yaml("backup_dir") or "")
+
+    @classmethod
+    def _getter_backup_compress(cls) -> bool:
+        value = cls._get_env("backup_compress") or cls._get_yaml("backup_compress")
+        return str(value).lower() in ("1", "true", "yes")
+
     @classmethod
     def _getter_teams(cls) -> list[str]:
         values = [str(cls._get_value("teams"))]
@@ -150,6 +224,8 @@ class Config(metaclass=ConfigMeta):
     pass
 
 
+log.configure(str(Config.log_level), str(Config.log_format))
+
 # Trigger checks for values that don't have defaults set
 _ = Config.password
 _ = Config.teams
@@ -1,29 +1,199 @@
-import flags
+import log
+import secrets
 
+from time import perf_counter
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.types import String, SmallInteger, BigInteger
+from sqlalchemy import ForeignKey, MetaData, event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.types import String, SmallInteger, Integer, BigInteger, Float
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from timeutils import time
 
 
 class Base(DeclarativeBase):
     pass
 
 
+class Exploits(Base):
+    """The names of the exploits, which are only a handful, referenced by the flags."""
+
+    __tablename__ = "exploits"
+
+    id: Mapped[int] = mapped_column(Integer(), primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(String(64), nullable=False, unique=True)
+
+
+class Messages(Base):
+    """The messages of the game system, which are only a few dozens."""
+
+    __tablename__ = "messages"
+
+    id: Mapped[int] = mapped_column(Integer(), primary_key=True, autoincrement=True)
+    text: Mapped[str] = mapped_column(String(128), nullable=False, unique=True)
+
+
 class Flags(Base):
     __tablename__ = "flags"
 
-    flag: Mapped[str] = mapped_column(String(64), primary_key=True, nullable=False)
-    exploit: Mapped[str] = mapped_column(String(64), nullable=False)
+    # The rowid, so that the text of a flag is only stored by the table and its index
+    # while the changes refer to it with a small integer
+    id: Mapped[int] = mapped_column(Integer(), primary_key=True, autoincrement=True)
+    flag: Mapped[str] = mapped_column(String(64), nullable=False, unique=True)
+    exploit_id: Mapped[int] = mapped_column(ForeignKey("exploits.id"), nullable=False)
+    team = mapped_column(String(64), nullable=True)
     status: Mapped[int] = mapped_column(SmallInteger(), nullable=False)
     timestamp: Mapped[int] = mapped_column(BigInteger(), nullable=False)
     submission_timestamp: Mapped[int] = mapped_column(BigInteger(), nullable=True)
-    system_message = mapped_column(String(128), nullable=True)
+    message_id = mapped_column(ForeignKey("messages.id"), nullable=True)
 
-    def submit_result(self, status: int | None, system_message: str | None):
-        self.status = status or flags.STATUS_UNKNOWN
-        self.system_message = system_message or "Unknown message"
-        self.submission_timestamp = time()
+
+class Changes(Base):
+    """Every insertion or update of a flag, numbered in order, for the peers to
+    replicate. They are never pruned, as a peer can always start from scratch."""
+
+    __tablename__ = "changes"
+
+    seq: Mapped[int] = mapped_column(Integer(), primary_key=True, autoincrement=True)
+    flag_id: Mapped[int] = mapped_column(ForeignKey(Flags.id), nullable=False)
+
+
+class Settings(Base):
+    """Values that belong to the database itself rather than to the configuration."""
+
+    __tablename__ = "settings"
+
+    key: Mapped[str] = mapped_column(String(32), primary_key=True)
+    value: Mapped[str] = mapped_column(String(128), nullable=False)
+
+
+class Jobs(Base):
+    __tablename__ = "jobs"
+
+    exploit: Mapped[str] = mapped_column(String(64), primary_key=True)
+    tick: Mapped[int] = mapped_column(BigInteger(), primary_key=True)
+    team: Mapped[str] = mapped_column(String(64), primary_key=True)
+    status: Mapped[int] = mapped_column(SmallInteger(), nullable=False)
+    attempts: Mapped[int] = mapped_column(SmallInteger(), nullable=False)
+    lease = mapped_column(String(32), nullable=True)
+    lease_expiry = mapped_column(BigInteger(), nullable=True)
+    runner = mapped_column(String(64), nullable=True)
+
+
+class Timings(Base):
+    """How long every run of an exploit took, as reported by the clients."""
+
+    __tablename__ = "timings"
+
+    id: Mapped[int] = mapped_column(Integer(), primary_key=True, autoincrement=True)
+    tick: Mapped[int] = mapped_column(BigInteger(), nullable=False)
+    exploit: Mapped[str] = mapped_column(String(64), nullable=False)
+    team: Mapped[str] = mapped_column(String(64), nullable=False)
+    runner = mapped_column(String(64), nullable=True)
+    status: Mapped[str] = mapped_column(String(16), nullable=False)
+    wall_time: Mapped[float] = mapped_column(Float(), nullable=False)
+    first_flag_time = mapped_column(Float(), nullable=True)
+    output_size: Mapped[int] = mapped_column(Integer(), nullable=False)
+    flags: Mapped[int] = mapped_column(Integer(), nullable=False)
 
 
 db = SQLAlchemy(model_class=Base)
+
+
+@event.listens_for(Engine, "connect")
+def _configure_connection(connection, _) -> None:
+    # WAL lets readers and the writer work at the same time, even from different
+    # processes, and NORMAL synchronization is still safe when using WAL
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def _normalize_flags(columns: set[str]) -> None:
+    # Flags used to repeat the name of the exploit and the message of the game system,
+    # and to be keyed (and referenced by the changes) by their text
+    log.info("Moving the flags to the compact schema, this could take a while...")
+    start = perf_counter()
+    changes = {x["name"] for x in inspect(db.engine).get_columns("changes")}
+    old_changes = "flag" in changes
+    team = "f.team" if "team" in columns else "NULL"
+    # Renaming the flags would make the foreign keys of the changes follow them, so
+    # the new table is built aside and takes their name once they are dropped
+    metadata = MetaData()
+    for table in (Exploits.__table__, Messages.__table__):
+        table.to_metadata(metadata)
+    new_flags = Flags.__table__.to_metadata(metadata, name="new_flags")
+    if old_changes:
+        db.session.execute(text("ALTER TABLE changes RENAME TO old_changes"))
+    else:
+        # Databases older than the changes got an empty table from create_all()
+        db.session.execute(text("DROP TABLE changes"))
+    connection = db.session.connection()
+    new_flags.create(connection)
+    statements = [
+        "INSERT INTO exploits (name) SELECT DISTINCT exploit FROM flags",
+        "INSERT INTO messages (text) SELECT DISTINCT system_message FROM flags "
+        "WHERE system_message IS NOT NULL",
+        # In order of time, so that the rows of recent flags are close to each other
+        "INSERT INTO new_flags (flag, exploit_id, team, status, timestamp, "
+        "submission_timestamp, message_id) "
+        f"SELECT f.flag, e.id, {team}, f.status, f.timestamp, f.submission_timestamp, "
+        "m.id FROM flags f JOIN exploits e ON e.name = f.exploit "
+        "LEFT JOIN messages m ON m.text = f.system_message ORDER BY f.timestamp",
+        "DROP TABLE flags",
+        "ALTER TABLE new_flags RENAME TO flags",
+    ]
+    for statement in statements:
+        db.session.execute(text(statement))
+    Changes.__table__.create(connection)
+    if old_changes:
+        # Keep the numbers of the changes, the peers remember them
+        db.session.execute(
+            text(
+                "INSERT INTO changes (seq, flag_id) SELECT c.seq, f.id FROM old_changes c "
+                "JOIN flags f ON f.flag = c.flag"
+            )
+        )
+        db.session.execute(text("DROP TABLE old_changes"))
+    db.session.commit()
+    log.info(f"Moved the flags to the compact schema in {perf_counter() - start:.2f}s")
+
+
+def new_epoch() -> None:
+    """Identifies the numbering of the changes with a new random epoch, so that the
+    peers replicate the database from scratch."""
+    Settings.__table__.create(db.engine, checkfirst=True)
+    db.session.merge(Settings(key="epoch", value=secrets.token_hex(8)))
+    db.session.commit()
+
+
+def current_epoch() -> str:
+    return db.session.get(Settings, "epoch").value
+
+
+def migrate() -> None:
+    columns = {x["name"] for x in inspect(db.engine).get_columns(Flags.__tablename__)}
+    if "exploit" in columns:
+        _normalize_flags(columns)
+        # Give the space of the old tables back to the file system
+        db.session.execute(text("VACUUM"))
+        columns = {x.name for x in Flags.__table__.columns}
+    # Add the columns that were introduced after the table was first created
+    for column in Flags.__table__.columns:
+        if column.name not in columns:
+            column_type = column.type.compile(db.engine.dialect)
+            db.session.execute(
+                text(
+                    f"ALTER TABLE {Flags.__tablename__} ADD COLUMN {column.name} {column_type}"
+                )
+            )
+    # Flags stored before changes were tracked must be replicated too
+    if db.session.execute(db.select(Changes.seq).limit(1)).first() is None:
+        db.session.execute(
+            db.insert(Changes).from_select(
+                ["flag_id"], db.select(Flags.id).order_by(Flags.timestamp)
+            )
+        )
+    db.session.commit()
+    # Fresh databases, and the ones from before the epoch was stored
+    if db.session.get(Settings, "epoch") is None:
+        new_epoch()
@@ -0,0 +1,99 @@
+import re
+import log
+
+from typing import Iterator, TypedDict
+from config import Config
+
+# The parser of the re module is private, and this is written against the one of the
+# Python of the Docker image (3.13). It was renamed in 3.11 and could change again, so
+# anything going wrong with it only leaves the clients without a prefilter.
+try:
+    from re import _parser
+except ImportError:
+    _parser = None
+
+
+class Prefilter(TypedDict):
+    # A string found at the same offset in every flag, if there is one
+    literal: str | None
+    offset: int
+    # The longest flag, if there is a limit
+    maxLength: int | None
+    # The bytes around a flag its lookarounds (and \b, ^ or $) can look at
+    context: int
+
+
+def _subpatterns(value: object) -> Iterator["_parser.SubPattern"]:
+    if isinstance(value, _parser.SubPattern):
+        yield value
+    elif isinstance(value, tuple | list):
+        for item in value:
+            yield from _subpatterns(item)
+
+
+def _lookaround(parsed: "_parser.SubPattern") -> int:
+    """Returns the width of the longest lookahead or lookbehind of a pattern."""
+    width = 0
+    for op, value in parsed.data:
+        if op in (_parser.ASSERT, _parser.ASSERT_NOT):
+            width = max(width, value[1].getwidth()[1])
+        for subpattern in _subpatterns(value):
+            width = max(width, _lookaround(subpattern))
+    return width
+
+
+def _prefilter(pattern: str) -> Prefilter | None:
+    parsed = _parser.parse(pattern, re.MULTILINE)
+    _, high = parsed.getwidth()
+    context = max(1, _lookaround(parsed))
+    # Without a limit, the output can only be searched once it is complete
+    bounded = high < _parser.MAXREPEAT and context < _parser.MAXREPEAT
+    result: Prefilter = {
+        "literal": None,
+        "offset": 0,
+        "maxLength": high if bounded else None,
+        "context": context if bounded else 1,
+    }
+    # Literals of case insensitive patterns can't be searched as they are
+    if parsed.state.flags & re.IGNORECASE:
+        return result
+
+    offset, start, literal = 0, 0, ""
+    for item in [*parsed.data, (None, None)]:
+        op, value = item
+        if op is _parser.LITERAL:
+            if not literal:
+                start = offset
+            literal += chr(value)
+            offset += 1
+            continue
+        if len(literal) > len(result["literal"] or ""):
+            result["literal"], result["offset"] = literal, start
+        literal = ""
+        if op is None:
+            break
+        low, high = _parser.SubPattern(parsed.state, [item]).getwidth()
+        # The offset of what follows depends on the flag
+        if low != high:
+            break
+        offset += low
+    return result
+
+
+def prefilter(pattern: str) -> Prefilter | None:
+    """Finds what the clients can look for in the output of the exploits before
+    running the whole flag format on it: the longest literal that every flag has at
+    a known offset, the maximum length of a flag and how much of the output around
+    it the format looks at."""
+    if _parser is None:
+        return None
+    try:
+        return _prefilter(pattern)
+    except Exception:
+        return None
+
+
+FLAG_FORMAT = str(Config.flag_format)
+PREFILTER = prefilter(FLAG_FORMAT)
+if PREFILTER is None:
+    log.warning(f"Could not parse the flag format {FLAG_FORMAT}")
@@ -1,13 +1,26 @@
 import log
+import atexit
+import secrets
+import metrics
 
 from typing import Any
+from time import perf_counter, sleep
+from heapq import heappush, heappop
+from bisect import bisect_left, insort
+from threading import Lock, Thread
+from abc import ABC, abstractmethod
 from config import Config
-from database import db, Flags
+from database import db, current_epoch, Flags, Changes, Exploits, Messages
+from journal import Journal, Record
 from timeutils import time, time_to_date
+from sqlalchemy import bindparam, case
 from sqlalchemy.dialects import sqlite
 
 
 _BATCH_LIMIT = int(Config.batch_limit)
+_FLAG_STORE = str(Config.flag_store)
+_FLAG_STORE_PATH = str(Config.flag_store_path)
+_SNAPSHOT_PERIOD = int(Config.snapshot_period)
 
 LIFETIME = int(Config.flag_lifetime) * int(Config.tick_duration)
 
@@ -17,24 +30,679 @@ STATUS_UNKNOWN = 2
 STATUS_ACCEPTED = 3
 STATUS_REJECTED = 4
 
-type Submission = dict[str, str | int]
+type Submission = dict[str, str | int | None]
 type SubmissionJson = dict[str, str | int | None]
+type TeamStats = dict[str, dict[str, int]]
+type PendingFlag = tuple[str, int]
+# A flag, its new status and the message of the game system
+type Result = tuple[str, int | None, str | None]
+# flag, exploit, status, timestamp, submission timestamp and message of the game system
+type Row = tuple[str, str, int, int, int | None, str | None]
+# flag, exploit, team, status, timestamp, submission timestamp and message
+type FlagRecord = list[str | int | None]
+
+_STATUS_NAMES = {
+    STATUS_PENDING: "pending",
+    STATUS_EXPIRED: "expired",
+    STATUS_UNKNOWN: "unknown",
+    STATUS_ACCEPTED: "accepted",
+    STATUS_REJECTED: "rejected",
+}
+
+
+# When two farms disagree on the status of a flag, the most final one wins
+_PRECEDENCE = {
+    STATUS_PENDING: 0,
+    STATUS_EXPIRED: 1,
+    STATUS_UNKNOWN: 2,
+    STATUS_REJECTED: 3,
+    STATUS_ACCEPTED: 4,
+}
+
+
+def status_name(status: int) -> str:
+    return _STATUS_NAMES.get(status, "unknown")
+
+
+def valid_status(status: object) -> bool:
+    return isinstance(status, int) and status in _STATUS_NAMES
+
+
+def overrides(status: int, current: int) -> bool:
+    return _PRECEDENCE[status] > _PRECEDENCE[current]
+
+
+class FlagStore(ABC):
+    # Identifies the numbering of the changes, which is only valid as long as it
+    # doesn't change
+    epoch = ""
+
+    @abstractmethod
+    def insert(self, submissions: list[Submission]) -> None:
+        """Stores new pending flags, ignoring the ones that were already stored."""
+        pass
+
+    @abstractmethod
+    def expire(self, threshold: int, now: int) -> int:
+        pass
+
+    @abstractmethod
+    def latest(self, offset: int, count: int) -> list[Row]:
+        pass
+
+    @abstractmethod
+    def team_counts(self, exploit: str, since: int) -> list[tuple[str, int, int]]:
+        """Returns the number of flags per team and status of an exploit."""
+        pass
+
+    @abstractmethod
+    def pending(self, limit: int) -> list[PendingFlag]:
+        """Returns the oldest pending flags."""
+        pass
+
+    @abstractmethod
+    def update(self, results: list[Result], now: int) -> None:
+        pass
+
+    @abstractmethod
+    def count_by_status(self) -> dict[int, int]:
+        pass
+
+    @abstractmethod
+    def oldest_pending(self) -> int | None:
+        pass
+
+    @abstractmethod
+    def changes(self, since: int, limit: int) -> list[tuple[int, FlagRecord]]:
+        """Returns the flags changed after the given change, along with the number of
+        the change."""
+        pass
+
+    @abstractmethod
+    def last_change(self) -> int:
+        pass
+
+    @abstractmethod
+    def merge(self, records: list[FlagRecord]) -> int:
+        """Stores the flags of another farm, unless the stored status of a flag takes
+        precedence. Returns the number of flags that changed."""
+        pass
+
+
+class SQLiteFlagStore(FlagStore):
+    def __init__(self) -> None:
+        self._epoch: str | None = None
+        # Names of exploits and messages are stored once, and their IDs never change
+        self._exploit_ids: dict[str, int] = {}
+        self._message_ids: dict[str, int] = {}
+
+    def _ids(
+        self, cache: dict[str, int], column: Any, values: set[str]
+    ) -> dict[str, int]:
+        """Returns the IDs of the entries of a dictionary table, adding the missing
+        ones."""
+        if len(missing := values - cache.keys()) > 0:
+            table = column.class_
+            db.session.execute(
+                sqlite.insert(table)
+                .values([{column.key: x} for x in missing])
+                .on_conflict_do_nothing()
+            )
+            rows = db.session.execute(
+                db.select(table.id, column).where(column.in_(missing))
+            ).all()
+            # Never cache an ID that could be rolled back later
+            db.session.commit()
+            cache.update({name: id for id, name in rows})
+        return cache
+
+    def _exploits(self, names: set[str]) -> dict[str, int]:
+        return self._ids(self._exploit_ids, Exploits.name, names)
+
+    def _messages(self, messages: set[str | None]) -> dict[str | None, int | None]:
+        ids: dict[str | None, int | None] = {None: None}
+        ids.update(self._ids(self._message_ids, Messages.text, messages - {None}))
+        return ids
+
+    def _track(self, ids: list[int]) -> None:
+        if len(ids) > 0:
+            db.session.execute(db.insert(Changes), [{"flag_id": x} for x in ids])
+
+    def insert(self, submissions: list[Submission]) -> None:
+        exploit_ids = self._exploits({str(x["exploit"]) for x in submissions})
+        inserted = db.session.execute(
+            sqlite.insert(Flags)
+            .values(
+                [
+                    {
+                        "flag": x["flag"],
+                        "exploit_id": exploit_ids[str(x["exploit"])],
+                        "team": x["team"],
+                        "status": x["status"],
+                        "timestamp": x["timestamp"],
+                    }
+                    for x in submissions
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["flag"])
+            .returning(Flags.id)
+        ).scalars()
+        self._track(list(inserted))
+        db.session.commit()
+
+    def expire(self, threshold: int, now: int) -> int:
+        message_ids = self._messages({"Expired"})
+        expired = db.session.execute(
+            db.update(Flags)
+            .where((Flags.status == STATUS_PENDING) & (Flags.timestamp <= threshold))
+            .values(
+                status=STATUS_EXPIRED,
+                submission_timestamp=now,
+                message_id=message_ids["Expired"],
+            )
+            .returning(Flags.id)
+        ).scalars()
+        expired = list(expired)
+        self._track(expired)
+        db.session.commit()
+        return len(expired)
+
+    def latest(self, offset: int, count: int) -> list[Row]:
+        rows = db.session.execute(
+            db.select(
+                Flags.flag,
+                Exploits.name,
+                Flags.status,
+                Flags.timestamp,
+                Flags.submission_timestamp,
+                Messages.text,
+            )
+            .join(Exploits)
+            .outerjoin(Messages)
+            .order_by(Flags.timestamp.desc())
+            .limit(count)
+            .offset(offset)
+        )
+        return [tuple(x) for x in rows]
+
+    def team_counts(self, exploit: str, since: int) -> list[tuple[str, int, int]]:
+        rows = db.session.execute(
+            db.select(Flags.team, Flags.status, db.func.count())
+            .join(Exploits)
+            .where(
+                (Exploits.name == exploit)
+                & (Flags.team.is_not(None))
+                & (Flags.timestamp > since)
+            )
+            .group_by(Flags.team, Flags.status)
+        )
+        return [tuple(x) for x in rows]
+
+    def pending(self, limit: int) -> list[PendingFlag]:
+        batch = db.session.execute(
+            db.select(Flags.flag, Flags.timestamp)
+            .where(Flags.status == STATUS_PENDING)
+            .order_by(Flags.timestamp.asc())
+            .limit(limit)
+        ).all()
+        # Don't keep the read transaction open while the batch is being submitted, other
+        # processes could write in the meantime and we could not upgrade it anymore
+        db.session.commit()
+        return [(flag, timestamp) for flag, timestamp in batch]
+
+    def update(self, results: list[Result], now: int) -> None:
+        message_ids = self._messages({message for _, _, message in results})
+        table = Flags.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.flag == bindparam("result_flag"))
+            .values(
+                status=bindparam("result_status"),
+                message_id=bindparam("result_message"),
+                submission_timestamp=now,
+            ),
+            [
+                {
+                    "result_flag": flag,
+                    "result_status": status,
+                    "result_message": message_ids[message],
+                }
+                for flag, status, message in results
+            ],
+        )
+        db.session.execute(
+            db.insert(Changes).from_select(
+                ["flag_id"],
+                db.select(Flags.id).where(
+                    Flags.flag.in_([flag for flag, _, _ in results])
+                ),
+            )
+        )
+        db.session.commit()
+
+    def count_by_status(self) -> dict[int, int]:
+        rows = db.session.execute(
+            db.select(Flags.status, db.func.count()).group_by(Flags.status)
+        )
+        return {status: count for status, count in rows}
+
+    def oldest_pending(self) -> int | None:
+        return db.session.execute(
+            db.select(db.func.min(Flags.timestamp)).where(
+                Flags.status == STATUS_PENDING
+            )
+        ).scalar()
+
+    def changes(self, since: int, limit: int) -> list[tuple[int, FlagRecord]]:
+        rows = db.session.execute(
+            db.select(
+                Changes.seq,
+                Flags.flag,
+                Exploits.name,
+                Flags.team,
+                Flags.status,
+                Flags.timestamp,
+                Flags.submission_timestamp,
+                Messages.text,
+            )
+            .join(Flags, Flags.id == Changes.flag_id)
+            .join(Exploits)
+            .outerjoin(Messages)
+            .where(Changes.seq > since)
+            .order_by(Changes.seq)
+            .limit(limit)
+        )
+        return [(seq, list(record)) for seq, *record in rows]
+
+    def last_change(self) -> int:
+        return db.session.execute(db.select(db.func.max(Changes.seq))).scalar() or 0
+
+    @property
+    def epoch(self) -> str:
+        # The changes are stored in the database, so they keep their epoch across
+        # restarts. It only changes when a backup is restored, before starting.
+        if self._epoch is None:
+            self._epoch = current_epoch()
+        return self._epoch
+
+    def merge(self, records: list[FlagRecord]) -> int:
+        exploit_ids = self._exploits({str(x[1]) for x in records})
+        message_ids = self._messages({x[6] for x in records})
+        statement = sqlite.insert(Flags).values(
+            [
+                {
+                    "flag": x[0],
+                    "exploit_id": exploit_ids[str(x[1])],
+                    "team": x[2],
+                    "status": x[3],
+                    "timestamp": x[4],
+                    "submission_timestamp": x[5],
+                    "message_id": message_ids[x[6]],
+                }
+                for x in records
+            ]
+        )
+        precedence = case(_PRECEDENCE, value=statement.excluded.status)
+        statement = statement.on_conflict_do_update(
+            index_elements=["flag"],
+            set_={
+                "status": statement.excluded.status,
+                "submission_timestamp": statement.excluded.submission_timestamp,
+                "message_id": statement.excluded.message_id,
+            },
+            where=precedence > case(_PRECEDENCE, value=Flags.status),
+        ).returning(Flags.id)
+        changed = list(db.session.execute(statement).scalars())
+        self._track(changed)
+        db.session.commit()
+        return len(changed)
+
+
+class _StoredFlag(object):
+    __slots__ = (
+        "flag",
+        "exploit",
+        "team",
+        "status",
+        "timestamp",
+        "submission_timestamp",
+        "system_message",
+    )
+
+    def __init__(self, record: Record):
+        (
+            self.flag,
+            self.exploit,
+            self.team,
+            self.status,
+            self.timestamp,
+            self.submission_timestamp,
+            self.system_message,
+        ) = record
+
+    def record(self) -> Record:
+        return [
+            self.flag,
+            self.exploit,
+            self.team,
+            self.status,
+            self.timestamp,
+            self.submission_timestamp,
+            self.system_message,
+        ]
+
+    def row(self) -> Row:
+        return (
+            self.flag,
+            self.exploit,
+            self.status,
+            self.timestamp,
+            self.submission_timestamp,
+            self.system_message,
+        )
+
+
+class MemoryFlagStore(FlagStore):
+    """Keeps every flag in memory, indexed by flag, status and timestamp.
+
+    Every change is appended to a journal before being applied, and the journal is
+    periodically compacted into a snapshot. Both are replayed on startup."""
+
+    # Journal record types
+    _INSERT = "i"
+    _EXPIRE = "e"
+    _UPDATE = "u"
+    _MERGE = "m"
+
+    def __init__(self, path: str) -> None:
+        self._lock = Lock()
+        self._flags: dict[str, _StoredFlag] = {}
+        # The flag changed by every change. They are numbered again on every start.
+        self._changes: list[str] = []
+        self.epoch = secrets.token_hex(8)
+        # Every flag sorted by timestamp, and a heap of the pending ones. Flags are
+        # never removed from the heap, the ones that are not pending anymore are skipped.
+        self._by_time: list[tuple[int, str]] = []
+        self._pending: list[tuple[int, str]] = []
+        self._counts = {status: 0 for status in _STATUS_NAMES}
+        # Inserted flags waiting for the journal to be on disk, by journal position
+        self._unapplied: dict[int, Record] = {}
+        self._journal = Journal(path)
+
+        start = perf_counter()
+        snapshot, journal = self._journal.recover()
+        for record in snapshot:
+            self._add(_StoredFlag(record))
+        for record in journal:
+            self._apply(record)
+        log.info(
+            f"Recovered {len(self._flags)} flags from {path} in {perf_counter() - start:.2f}s"
+        )
+        self._snapshot()
+        Thread(target=self._compact, daemon=True, name="flag-snapshots").start()
+
+    def _add(self, flag: _StoredFlag) -> None:
+        self._flags[flag.flag] = flag
+        # Flags mostly arrive in order, so this is usually an append
+        insort(self._by_time, (flag.timestamp, flag.flag))
+        self._counts[flag.status] += 1
+        self._changes.append(flag.flag)
+        if flag.status == STATUS_PENDING:
+            heappush(self._pending, (flag.timestamp, flag.flag))
+
+    def _set_status(
+        self, flag: _StoredFlag, status: int, message: str | None, now: int | None
+    ) -> None:
+        self._counts[flag.status] -= 1
+        self._counts[status] += 1
+        self._changes.append(flag.flag)
+        flag.status = status
+        flag.system_message = message
+        flag.submission_timestamp = now
+
+    def _apply(self, record: Record) -> int:
+        match record:
+            case [self._INSERT, flags]:
+                for flag, exploit, team, timestamp in flags:
+                    if flag not in self._flags:
+                        self._add(
+                            _StoredFlag(
+                                [
+                                    flag,
+                                    exploit,
+                                    team,
+                                    STATUS_PENDING,
+                                    timestamp,
+                                    None,
+                                    None,
+                                ]
+                            )
+                        )
+            case [self._EXPIRE, threshold, now]:
+                expired = 0
+                while self._pending and self._pending[0][0] <= threshold:
+                    flag = self._flags[heappop(self._pending)[1]]
+                    if flag.status == STATUS_PENDING:
+                        self._set_status(flag, STATUS_EXPIRED, "Expired", now)
+                        expired += 1
+                return expired
+            case [self._UPDATE, results, now]:
+                for flag, status, message in results:
+                    if (stored := self._flags.get(flag)) is not None:
+                        self._set_status(stored, status, message, now)
+            case [self._MERGE, records]:
+                changed = 0
+                for record in records:
+                    if (stored := self._flags.get(record[0])) is None:
+                        self._add(_StoredFlag(record))
+                    elif overrides(record[3], stored.status):
+                        self._set_status(stored, record[3], record[6], record[5])
+                    else:
+                        continue
+                    changed += 1
+                return changed
+        return 0
+
+    def _log(self, record: Record) -> int:
+        # Called with the lock held, so that the journal has the same order as the changes
+        position = self._journal.append(record)
+        self._apply(record)
+        return position
+
+    def insert(self, submissions: list[Submission]) -> None:
+        with self._lock:
+            new = [
+                [x["flag"], x["exploit"], x["team"], x["timestamp"]]
+                for x in submissions
+                if x["flag"] not in self._flags
+            ]
+            if len(new) == 0:
+                return
+            record = [self._INSERT, new]
+            position = self._journal.append(record)
+            self._unapplied[position] = record
+        # Clients only forget the flags they sent when they are acknowledged, so wait
+        # until they are safely on disk. Writers arriving meanwhile share the same fsync.
+        # The flags are not submitted nor shown before that, so a failed write loses
+        # nothing: the client keeps them and sends them again.
+        try:
+            self._journal.wait(position)
+        except OSError:
+            with self._lock:
+                del self._unapplied[position]
+            raise
+        with self._lock:
+            del self._unapplied[position]
+            # Flags merged meanwhile are kept as they are, and the next expiry catches
+            # the ones an expiry that ran meanwhile did not see
+            self._apply(record)
+
+    def expire(self, threshold: int, now: int) -> int:
+        with self._lock:
+            if not self._pending or self._pending[0][0] > threshold:
+                return 0
+            record = [self._EXPIRE, threshold, now]
+            self._journal.append(record)
+            return self._apply(record)
+
+    def latest(self, offset: int, count: int) -> list[Row]:
+        with self._lock:
+            end = max(len(self._by_time) - offset, 0)
+            entries = self._by_time[max(end - count, 0) : end]
+            return [self._flags[flag].row() for _, flag in reversed(entries)]
+
+    def team_counts(self, exploit: str, since: int) -> list[tuple[str, int, int]]:
+        counts: dict[tuple[str, int], int] = {}
+        with self._lock:
+            # Find the first flag newer than since
+            first = bisect_left(self._by_time, (since + 1,))
+            for _, name in self._by_time[first:]:
+                flag = self._flags[name]
+                if flag.exploit == exploit and flag.team is not None:
+                    key = (flag.team, flag.status)
+                    counts[key] = counts.get(key, 0) + 1
+        return [(team, status, count) for (team, status), count in counts.items()]
+
+    def pending(self, limit: int) -> list[PendingFlag]:
+        with self._lock:
+            batch: list[tuple[int, str]] = []
+            while self._pending and len(batch) < limit:
+                entry = heappop(self._pending)
+                if self._flags[entry[1]].status == STATUS_PENDING:
+                    batch.append(entry)
+            # They are still pending until the game system says otherwise
+            for entry in batch:
+                heappush(self._pending, entry)
+        return [(flag, timestamp) for timestamp, flag in batch]
+
+    def update(self, results: list[Result], now: int) -> None:
+        with self._lock:
+            self._log([self._UPDATE, [list(x) for x in results], now])
+
+    def count_by_status(self) -> dict[int, int]:
+        with self._lock:
+            return dict(self._counts)
+
+    def oldest_pending(self) -> int | None:
+        with self._lock:
+            while self._pending:
+                timestamp, flag = self._pending[0]
+                if self._flags[flag].status == STATUS_PENDING:
+                    return timestamp
+                heappop(self._pending)
+        return None
+
+    def changes(self, since: int, limit: int) -> list[tuple[int, FlagRecord]]:
+        with self._lock:
+            return [
+                (seq, self._flags[flag].record())
+                for seq, flag in enumerate(
+                    self._changes[since : since + limit], start=since + 1
+                )
+            ]
+
+    def last_change(self) -> int:
+        return len(self._changes)
+
+    def merge(self, records: list[FlagRecord]) -> int:
+        with self._lock:
+            record = [self._MERGE, records]
+            self._journal.append(record)
+            return self._apply(record)
+
+    def _snapshot(self) -> None:
+        start = perf_counter()
+        with self._lock:
+            records = [flag.record() for flag in self._flags.values()]
+            # The journals of the flags still being written are removed along with the
+            # others, so the snapshot must have them too
+            unapplied = {}
+            for _, flags in self._unapplied.values():
+                for flag, exploit, team, timestamp in flags:
+                    if flag not in self._flags:
+                        unapplied[flag] = [
+                            flag,
+                            exploit,
+                            team,
+                            STATUS_PENDING,
+                            timestamp,
+                            None,
+                            None,
+                        ]
+            records += unapplied.values()
+            generation = self._journal.rotate()
+        try:
+            self._journal.snapshot(generation, records)
+            log.info(
+                f"Saved a snapshot of {len(records)} flags in {perf_counter() - start:.2f}s"
+            )
+        except OSError as e:
+            log.error(f"Could not save a snapshot of the flags. {e}")
+
+    def _compact(self) -> None:
+        while True:
+            sleep(_SNAPSHOT_PERIOD)
+            self._snapshot()
+
+    def close(self) -> None:
+        self._journal.sync()
+
+
+def _open_store() -> FlagStore:
+    match _FLAG_STORE.lower():
+        case "sqlite":
+            return SQLiteFlagStore()
+        case "memory":
+            store = MemoryFlagStore(_FLAG_STORE_PATH)
+            atexit.register(store.close)
+            return store
+    log.fatal(f"Unknown flag store {_FLAG_STORE}")
+
+
+_store = _open_store()
+
+
+def count_by_status() -> dict[str, int]:
+    counts = {name: 0 for name in _STATUS_NAMES.values()}
+    for status, count in _store.count_by_status().items():
+        counts[status_name(status)] += count
+    return counts
+
+
+def _count_by_status() -> metrics.Samples:
+    return {(name,): count for name, count in count_by_status().items()}
+
+
+def _oldest_pending_age() -> metrics.Samples:
+    oldest = _store.oldest_pending()
+    return {(): time() - oldest if oldest is not None else 0}
+
+
+_DB_TIME = metrics.Histogram(
+    "farm_db_seconds", "Time spent on flag database operations", ("operation",)
+)
+_INGEST_SIZE = metrics.Histogram(
+    "farm_ingest_batch_size",
+    "Number of flags in every batch pushed by the clients",
+    buckets=metrics.SIZE_BUCKETS,
+)
+_EXPIRED = metrics.Counter("farm_expired_flags_total", "Number of flags that expired")
+metrics.Gauge("farm_flags", "Number of flags per status", _count_by_status, ("status",))
+metrics.Gauge(
+    "farm_pending_oldest_age_seconds",
+    "Age of the oldest pending flag",
+    _oldest_pending_age,
+)
 
 
 def mark_expired() -> None:
     now = time()
     expire_threshold = now - LIFETIME
     log.info(f"Expiring all flags older than {time_to_date(expire_threshold)}")
-    db.session.execute(
-        db.update(Flags)
-        .where((Flags.status == STATUS_PENDING) & (Flags.timestamp <= expire_threshold))
-        .values(
-            status=STATUS_EXPIRED,
-            submission_timestamp=now,
-            system_message="Expired",
-        )
-    )
-    db.session.commit()
+    start = perf_counter()
+    expired = _store.expire(expire_threshold, now)
+    _DB_TIME.observe(perf_counter() - start, "mark_expired")
+    _EXPIRED.inc(amount=expired)
 
 
 def queue(exploit: str, user_data: Any) -> None:
@@ -42,15 +710,21 @@ def queue(exploit: str, user_data: Any) -> None:
         if isinstance(data, str):
             return {
                 "exploit": exploit,
+                "team": None,
                 "flag": data,
                 "timestamp": time(),
                 "status": STATUS_PENDING,
             }
         elif isinstance(data, dict) and isinstance(data.get("flag"), str):
+            team = data.get("team")
+            timestamp = data.get("ts")
             return {
                 "exploit": exploit,
+                "team": team if isinstance(team, str) else None,
                 "flag": data["flag"],
-                "timestamp": data.get("ts", time()),
+                "timestamp": int(timestamp)
+                if isinstance(timestamp, int | float)
+                else time(),
                 "status": STATUS_PENDING,
             }
         else:
@@ -64,45 +738,75 @@ def queue(exploit: str, user_data: Any) -> None:
         return
 
     log.info(f"Submitted {len(submitted_flags)} for exploit {exploit}")
-    db.session.execute(
-        sqlite.insert(Flags)
-        .values(submitted_flags)
-        .on_conflict_do_nothing(index_elements=["flag"])
-    )
-    db.session.commit()
+    _INGEST_SIZE.observe(len(submitted_flags))
+    start = perf_counter()
+    _store.insert(submitted_flags)
+    _DB_TIME.observe(perf_counter() - start, "queue")
 
 
 def query(offset: int, count: int) -> list[SubmissionJson]:
-    def convert_objects_to_json(flag: Flags) -> SubmissionJson:
+    def convert_row_to_json(row: Row) -> SubmissionJson:
+        flag, exploit, status, timestamp, submission_timestamp, system_message = row
         submission_timestamp = (
-            flag.submission_timestamp
-            if flag.submission_timestamp is not None and flag.submission_timestamp > 0
+            submission_timestamp
+            if submission_timestamp is not None and submission_timestamp > 0
             else None
         )
-        lifetime = (submission_timestamp or time()) - flag.timestamp
+        lifetime = (submission_timestamp or time()) - timestamp
         # NOTE: JSON uses camelCase, we use snake_case, so this is going to look a bit weird
         return {
-            "flag": flag.flag,
-            "exploit": flag.exploit,
-            "status": flag.status,
-            "timestamp": flag.timestamp,
+            "flag": flag,
+            "exploit": exploit,
+            "status": status,
+            "timestamp": timestamp,
             "submissionTimestamp": submission_timestamp,
-            "systemMessage": flag.system_message,
+            "systemMessage": system_message,
             "lifetime": lifetime,
         }
 
-    flags = db.session.execute(
-        db.select(Flags).order_by(Flags.timestamp.desc()).limit(count).offset(offset)
-    ).scalars()
-    return list(map(convert_objects_to_json, flags))
+    return list(map(convert_row_to_json, _store.latest(offset, count)))
 
 
-def next_batch() -> list[Flags]:
-    return list(
-        db.session.execute(
-            db.select(Flags)
-            .where(Flags.status == STATUS_PENDING)
-            .order_by(Flags.timestamp.asc())
-            .limit(_BATCH_LIMIT)
-        ).scalars()
+def team_stats(exploit: str) -> TeamStats:
+    stats: TeamStats = {}
+    for team, status, count in _store.team_counts(exploit, time() - LIFETIME):
+        team_entry = stats.setdefault(team, {x: 0 for x in _STATUS_NAMES.values()})
+        team_entry[status_name(status)] += count
+    return stats
+
+
+def next_batch() -> list[PendingFlag]:
+    start = perf_counter()
+    batch = _store.pending(_BATCH_LIMIT)
+    _DB_TIME.observe(perf_counter() - start, "next_batch")
+    return batch
+
+
+def changes(since: int, limit: int) -> tuple[str, list[tuple[int, FlagRecord]]]:
+    # The numbering started again, the peer has to start from scratch
+    if since > _store.last_change():
+        since = 0
+    return _store.epoch, _store.changes(since, limit)
+
+
+def merge(records: list[FlagRecord]) -> int:
+    if len(records) == 0:
+        return 0
+    start = perf_counter()
+    changed = _store.merge(records)
+    _DB_TIME.observe(perf_counter() - start, "merge")
+    return changed
+
+
+def submit_results(results: list[Result]) -> None:
+    if len(results) == 0:
+        return
+    start = perf_counter()
+    _store.update(
+        [
+            (flag, status or STATUS_UNKNOWN, message or "Unknown message")
+            for flag, status, message in results
+        ],
+        time(),
     )
+    _DB_TIME.observe(perf_counter() - start, "submit_results")
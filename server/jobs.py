@@ -0,0 +1,156 @@
+import ticks
+import secrets
+import metrics
+
+from config import Config
+from database import db, Jobs
+from timeutils import time
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import sqlite
+
+
+# Runners that don't renew their lease in time lose their jobs, which are then handed
+# out again to the next runner asking for work
+LEASE_DURATION = int(Config.job_lease)
+# A job that keeps losing its lease is probably making the exploit hang, give up on it
+_MAX_ATTEMPTS = 3
+
+JOB_QUEUED = 0
+JOB_LEASED = 1
+JOB_SUCCEEDED = 2
+JOB_FAILED = 3
+JOB_SKIPPED = 4
+
+_RESULTS = {
+    "success": JOB_SUCCEEDED,
+    "failure": JOB_FAILED,
+    "skipped": JOB_SKIPPED,
+}
+
+type Lease = dict[str, str | int | list[str] | None]
+# A team and the outcome of the attack reported by the runner
+type JobResult = tuple[str, str]
+
+_JOBS = metrics.Counter("farm_jobs_total", "Attack jobs handed out", ("event",))
+
+# The jobs of the current tick that were already created by this process
+_created: set[tuple[str, int]] = set()
+
+
+def _create(exploit: str, tick: int) -> None:
+    if (exploit, tick) in _created:
+        return
+    if any(x[1] != tick for x in _created):
+        _created.clear()
+    result = db.session.execute(
+        sqlite.insert(Jobs)
+        .values(
+            [
+                {
+                    "exploit": exploit,
+                    "tick": tick,
+                    "team": team,
+                    "status": JOB_QUEUED,
+                    "attempts": 0,
+                }
+                for team in Config.teams
+            ]
+        )
+        .on_conflict_do_nothing()
+    )
+    if result.rowcount > 0:
+        # Jobs are created once per tick, a good moment to drop the stale ones
+        db.session.execute(
+            db.delete(Jobs).where(Jobs.tick < tick - int(Config.flag_lifetime))
+        )
+    _created.add((exploit, tick))
+
+
+def lease(exploit: str, runner: str, count: int) -> Lease:
+    tick = ticks.current()
+    now = time()
+    token = secrets.token_hex(16)
+    _create(exploit, tick)
+    available = (
+        db.select(Jobs.team)
+        .where(
+            (Jobs.exploit == exploit)
+            & (Jobs.tick == tick)
+            & (Jobs.attempts < _MAX_ATTEMPTS)
+            & (
+                (Jobs.status == JOB_QUEUED)
+                | ((Jobs.status == JOB_LEASED) & (Jobs.lease_expiry <= now))
+            )
+        )
+        .order_by(Jobs.attempts, Jobs.team)
+        .limit(count)
+    )
+    # A single UPDATE takes the write lock before looking for the jobs, so two runners
+    # (even served by different processes) can never get the same job
+    db.session.execute(
+        db.update(Jobs)
+        .where(
+            (Jobs.exploit == exploit)
+            & (Jobs.tick == tick)
+            & Jobs.team.in_(available.scalar_subquery())
+        )
+        .values(
+            status=JOB_LEASED,
+            attempts=Jobs.attempts + 1,
+            lease=token,
+            lease_expiry=now + LEASE_DURATION,
+            runner=runner,
+        )
+    )
+    leased = db.session.execute(
+        db.select(Jobs.team, Jobs.attempts).where(Jobs.lease == token)
+    ).all()
+    db.session.commit()
+
+    _JOBS.inc("leased", amount=len(leased))
+    _JOBS.inc("reissued", amount=len([x for x in leased if x[1] > 1]))
+    return {
+        "lease": token if len(leased) > 0 else None,
+        "tick": tick,
+        "expiry": now + LEASE_DURATION,
+        "teams": [team for team, _ in leased],
+    }
+
+
+def renew(token: str) -> bool:
+    result = db.session.execute(
+        db.update(Jobs)
+        .where((Jobs.lease == token) & (Jobs.status == JOB_LEASED))
+        .values(lease_expiry=time() + LEASE_DURATION)
+    )
+    db.session.commit()
+    return result.rowcount > 0
+
+
+def valid_result(result: object) -> bool:
+    return isinstance(result, str) and result in _RESULTS
+
+
+def complete(token: str, results: list[JobResult]) -> int:
+    """Records the outcome of leased jobs, returning how many of them still belonged to
+    the lease."""
+    if len(results) == 0:
+        return 0
+    table = Jobs.__table__
+    result = db.session.execute(
+        table.update()
+        .where(
+            (table.c.lease == token)
+            & (table.c.status == JOB_LEASED)
+            & (table.c.team == bindparam("job_team"))
+        )
+        .values(status=bindparam("job_status")),
+        [
+            {"job_team": team, "job_status": _RESULTS[outcome]}
+            for team, outcome in results
+        ],
+    )
+    db.session.commit()
+    for _, outcome in results:
+        _JOBS.inc(outcome)
+    return result.rowcount
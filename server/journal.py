@@ -0,0 +1,166 @@
+import os
+import json
+import log
+
+from typing import Any, Iterable, Iterator
+from threading import Condition, Thread
+
+
+type Record = Any
+
+_SNAPSHOT = "snapshot.jsonl"
+
+
+def _journal_name(generation: int) -> str:
+    return f"journal.{generation:08d}.jsonl"
+
+
+def _fsync_dir(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_lines(path: str) -> Iterator[Record]:
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # The last line could have been torn by a crash
+                log.warning(f"Ignoring a corrupted record in {path}")
+                return
+
+
+class Journal(object):
+    """Append-only log of JSON records, periodically compacted into a snapshot.
+
+    Records are written by a single thread: everything appended while it waits for the
+    disk is written and synced at once, so concurrent writers share the same fsync."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._cond = Condition()
+        # Appended lines, or the generation of the next journal file to switch to
+        self._buffer: list[str | int] = []
+        self._appended = 0
+        self._synced = 0
+        # The positions of the last batch that could not be written, and why
+        self._failed: tuple[int, int, OSError] | None = None
+        self._generation = max(self._generations(), default=0) + 1
+        self._file = open(self._path(_journal_name(self._generation)), "a")
+        Thread(target=self._write, daemon=True, name="journal-writer").start()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _generations(self) -> list[int]:
+        generations = []
+        for name in os.listdir(self.directory):
+            parts = name.split(".")
+            if len(parts) == 3 and parts[0] == "journal" and parts[1].isdigit():
+                generations.append(int(parts[1]))
+        return sorted(generations)
+
+    def recover(self) -> tuple[Iterator[Record], Iterator[Record]]:
+        """Returns the records of the last snapshot, and the records appended after it."""
+        snapshot_path = self._path(_SNAPSHOT)
+        snapshot: Iterator[Record] = iter(())
+        first_generation = 0
+        if os.path.exists(snapshot_path):
+            snapshot = _read_lines(snapshot_path)
+            # The header says which journals were already compacted into the snapshot
+            first_generation = next(snapshot, {}).get("generation", 0)
+
+        def journals() -> Iterator[Record]:
+            for generation in self._generations():
+                if first_generation <= generation < self._generation:
+                    yield from _read_lines(self._path(_journal_name(generation)))
+
+        return snapshot, journals()
+
+    def _write(self) -> None:
+        while True:
+            with self._cond:
+                while len(self._buffer) == 0:
+                    self._cond.wait()
+                buffer, self._buffer = self._buffer, []
+                first, target = self._synced, self._appended
+            try:
+                for entry in buffer:
+                    if isinstance(entry, int):
+                        self._switch(entry)
+                    else:
+                        self._file.write(entry)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                failed = None
+            except OSError as e:
+                log.error(f"Could not write the flag journal. {e}")
+                failed = (first, target, e)
+            with self._cond:
+                self._synced = target
+                # Writers waiting for this batch could wake up only after the next one
+                self._failed = failed or self._failed
+                self._cond.notify_all()
+
+    def _switch(self, generation: int) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = open(self._path(_journal_name(generation)), "a")
+        _fsync_dir(self.directory)
+
+    def append(self, record: Record) -> int:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._cond:
+            self._buffer.append(line)
+            self._appended += 1
+            self._cond.notify_all()
+            return self._appended
+
+    def wait(self, position: int) -> None:
+        """Blocks until the record at the given position is on disk, and raises the
+        error of the write if it could not be written."""
+        with self._cond:
+            while self._synced < position:
+                self._cond.wait()
+            if (
+                self._failed is not None
+                and self._failed[0] < position <= self._failed[1]
+            ):
+                raise self._failed[2]
+
+    def sync(self) -> None:
+        with self._cond:
+            position = self._appended
+        self.wait(position)
+
+    def rotate(self) -> int:
+        """Starts a new journal file, and returns the generation a snapshot would
+        cover. Saving that snapshot removes every journal before the generation, so it
+        must hold every record appended before rotating, whether it is on disk yet or
+        not, and nothing may be appended between taking the snapshot and rotating."""
+        with self._cond:
+            self._generation += 1
+            self._buffer.append(self._generation)
+            self._cond.notify_all()
+            return self._generation
+
+    def snapshot(self, generation: int, records: Iterable[Record]) -> None:
+        temporary = self._path(f"{_SNAPSHOT}.tmp")
+        with open(temporary, "w") as f:
+            f.write(json.dumps({"generation": generation}) + "\n")
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self._path(_SNAPSHOT))
+        _fsync_dir(self.directory)
+        # The journals before the snapshot are not needed anymore
+        for old in self._generations():
+            if old < generation:
+                os.remove(self._path(_journal_name(old)))
@@ -1,7 +1,13 @@
+import os
 import sys
+import json
+import atexit
 
+from queue import Queue, Full
+from threading import Thread
 from typing import NoReturn
-from timeutils import date
+from time import time as get_time
+from timeutils import time_to_date
 
 
 _COLOR_INFO = "\033[1;36m"
@@ -9,28 +15,199 @@ _COLOR_WARNING = "\033[1;33m"
 _COLOR_ERROR = "\033[1;31m"
 _COLOR_FATAL = "\033[1;41;97m"
 
+LEVEL_INFO = 0
+LEVEL_WARNING = 1
+LEVEL_ERROR = 2
+LEVEL_FATAL = 3
 
-def _p(*args, **kwargs) -> None:
-    print(f"{date()} |", *args, "\033[0m", **kwargs, flush=True, file=sys.stderr)
+_LEVELS = {
+    "info": LEVEL_INFO,
+    "warning": LEVEL_WARNING,
+    "error": LEVEL_ERROR,
+    "fatal": LEVEL_FATAL,
+}
+_NAMES = list(_LEVELS)
+_TAGS = ["[INFO]", "[WARN]", "[ERRO]", "[CRIT]"]
+_COLORS = [_COLOR_INFO, _COLOR_WARNING, _COLOR_ERROR, _COLOR_FATAL]
 
+_QUEUE_SIZE = 10000
 
-def info(o: object, *args, **kwargs) -> None:
-    _p(f"{_COLOR_INFO}[INFO]", str(o).strip(), *args, **kwargs)
+# Messages are written to stderr by a single background thread, so that threads
+# serving requests never contend on stderr or wait for it to be flushed
+_queue: Queue[tuple[float, int, str] | None] = Queue(_QUEUE_SIZE)
+_writer: Thread | None = None
+# Processes that must not run threads write their messages right away
+_background = True
+_dropped = 0
+_level = LEVEL_INFO
+_json = False
 
 
-def warning(o: object, *args, **kwargs) -> None:
-    _p(f"{_COLOR_WARNING}[WARN]", str(o).strip(), *args, **kwargs)
+def configure(level: str, output_format: str) -> None:
+    global _level, _json
 
+    if (value := _LEVELS.get(level.lower())) is None:
+        warning(f"Unknown log level '{level}', using 'info'")
+        value = LEVEL_INFO
+    _level = value
+    _json = output_format.lower() == "json"
 
-def error(o: object, *args, **kwargs) -> None:
-    _p(f"{_COLOR_ERROR}[ERRO]", str(o).strip(), *args, **kwargs)
 
+def enabled(level: int) -> bool:
+    return level >= _level
 
-def fatal(o: object, *args, **kwargs) -> NoReturn:
-    _p(f"{_COLOR_FATAL}[CRIT]", str(o).strip(), *args, **kwargs)
+
+def _format(timestamp: float, level: int, message: str, date: str) -> str:
+    if _json:
+        return json.dumps(
+            {"time": timestamp, "level": _NAMES[level], "message": message}
+        )
+    return f"{date} | {_COLORS[level]}{_TAGS[level]} {message} \033[0m"
+
+
+def _write_now(timestamp: float, level: int, message: str) -> None:
+    date = time_to_date(int(timestamp))
+    sys.stderr.write(_format(timestamp, level, message, date) + "\n")
+    sys.stderr.flush()
+
+
+def _write() -> None:
+    global _dropped
+
+    # Dates only change once per second, no need to format them for every message
+    last_second = None
+    date = ""
+    while (entry := _queue.get()) is not None:
+        timestamp, level, message = entry
+        if (second := int(timestamp)) != last_second:
+            last_second = second
+            date = time_to_date(second)
+        if _dropped > 0:
+            dropped, _dropped = _dropped, 0
+            sys.stderr.write(
+                _format(timestamp, LEVEL_WARNING, f"Dropped {dropped} messages", date)
+                + "\n"
+            )
+        sys.stderr.write(_format(timestamp, level, message, date) + "\n")
+        if _queue.empty():
+            sys.stderr.flush()
+        _queue.task_done()
+    _queue.task_done()
+
+
+def _start_writer() -> None:
+    global _writer
+
+    if not _background:
+        return
+    _writer = Thread(target=_write, daemon=True, name="log-writer")
+    _writer.start()
+
+
+def _stop_writer() -> None:
+    if _writer is not None and _writer.is_alive():
+        _queue.put(None)
+        _writer.join()
+
+
+def _restart_writer_in_child() -> None:
+    global _queue, _background
+
+    # The queue could have been locked by a thread that doesn't exist anymore
+    _queue = Queue(_QUEUE_SIZE)
+    _background = True
+    _start_writer()
+
+
+def write_directly() -> None:
+    """Stops the background writer for good in this process, whose messages are then
+    written by the threads logging them. Forked children get their own writer."""
+    global _background
+
+    _stop_writer()
+    _background = False
+
+
+def flush() -> None:
+    if _writer is not None and _writer.is_alive():
+        _queue.join()
+
+
+def _message(o: object, args: tuple) -> str:
+    return " ".join([str(o).strip(), *map(str, args)])
+
+
+def _p(level: int, o: object, *args) -> None:
+    global _dropped
+
+    if level < _level:
+        return
+    if not _background:
+        _write_now(get_time(), level, _message(o, args))
+        return
+    try:
+        _queue.put_nowait((get_time(), level, _message(o, args)))
+    except Full:
+        _dropped += 1
+
+
+def info(o: object, *args) -> None:
+    _p(LEVEL_INFO, o, *args)
+
+
+def warning(o: object, *args) -> None:
+    _p(LEVEL_WARNING, o, *args)
+
+
+def error(o: object, *args) -> None:
+    _p(LEVEL_ERROR, o, *args)
+
+
+def fatal(o: object, *args) -> NoReturn:
+    # Never drop the last words
+    if _background:
+        _queue.put((get_time(), LEVEL_FATAL, _message(o, args)))
+        flush()
+    else:
+        _write_now(get_time(), LEVEL_FATAL, _message(o, args))
     exit(-1)
 
 
-def ensure(condition: bool, o: object, *args, **kwargs) -> NoReturn | None:
+def ensure(condition: bool, o: object, *args) -> NoReturn | None:
     if not condition:
-        fatal(o, *args, **kwargs)
+        fatal(o, *args)
+
+
+class RateLimiter(object):
+    """Lets through at most `rate` messages per second for every key."""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        # key -> [second, messages in that second, suppressed messages]
+        self._windows: dict[str, list[int]] = {}
+
+    def allow(self, key: str) -> tuple[bool, int]:
+        """Returns whether the message should be logged and how many were suppressed
+        since the last one that was."""
+        second = int(get_time())
+        if (window := self._windows.get(key)) is None:
+            window = self._windows[key] = [second, 0, 0]
+        if window[0] != second:
+            window[0] = second
+            window[1] = 0
+        if window[1] >= self.rate:
+            window[2] += 1
+            return False, 0
+        window[1] += 1
+        suppressed, window[2] = window[2], 0
+        return True, suppressed
+
+
+_start_writer()
+atexit.register(flush)
+# Don't fork while the writer thread is holding the lock of stderr
+os.register_at_fork(
+    before=_stop_writer,
+    after_in_parent=_start_writer,
+    after_in_child=_restart_writer_in_child,
+)
@@ -1,20 +1,136 @@
+import os
+import sys
+import log
+import backup
+import admission
+import signal
+import socket
 import worker
+import replication
 
+from typing import Callable, Iterable, NoReturn
 from threading import Thread
 from waitress import serve
+from werkzeug.exceptions import NotFound
 from app import app
-from database import db
+from database import db, migrate
 from config import Config
 
 
-_worker = Thread(daemon=True, target=worker.task, args=(app,))
+_WEB_WORKERS = int(Config.web_workers)
+_TASKS_PORT = int(Config.tasks_port)
+
+
+def _start_tasks() -> Thread:
+    # The threads are created here, a process forked from this one can't start the
+    # threads created before the fork
+    submitter = Thread(daemon=True, target=worker.task, args=(app,))
+    submitter.start()
+    if len(replication.PEERS) > 0:
+        Thread(daemon=True, target=replication.task, args=(app,)).start()
+    if backup.BACKUP_DIR:
+        Thread(daemon=True, target=backup.task, args=(app,)).start()
+    return submitter
+
+
+def _serve_child(sockets: list[socket.socket]) -> NoReturn:
+    # Never share the database connections of the parent
+    with app.app_context():
+        db.engine.dispose(close=False)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        serve(app, sockets=sockets, threads=admission.THREADS)
+    finally:
+        log.flush()
+        os._exit(0)
+
+
+def _metrics_only(environ: dict, start_response: Callable) -> Iterable[bytes]:
+    if environ.get("PATH_INFO") != "/metrics":
+        return NotFound()(environ, start_response)
+    return app(environ, start_response)
+
+
+def _run_tasks_child(sockets: list[socket.socket]) -> NoReturn:
+    for sock in sockets:
+        sock.close()
+    with app.app_context():
+        db.engine.dispose(close=False)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        submitter = _start_tasks()
+        # The metrics of the tasks (submissions, expiry, replication, backups) are
+        # only recorded in this process, which serves them on a port of its own
+        Thread(
+            daemon=True,
+            target=serve,
+            args=(_metrics_only,),
+            kwargs={"host": Config.address, "port": _TASKS_PORT, "threads": 2},
+        ).start()
+        # The submitter only returns if it crashed, then the supervisor starts over
+        submitter.join()
+    finally:
+        log.flush()
+        os._exit(0)
+
+
+def _serve_prefork(workers: int) -> None:
+    log.ensure(
+        str(Config.database) != ":memory:",
+        "An in-memory database cannot be shared by multiple web workers",
+    )
+    log.ensure(
+        str(Config.flag_store).lower() != "memory",
+        "The memory flag store cannot be shared by multiple web workers",
+    )
+    # Every worker accepts connections from the same listening socket
+    sock = socket.create_server((str(Config.address), int(Config.port)), backlog=1024)
+    # This process only forks and supervises the others, so it never runs a thread:
+    # a child forked while another thread holds a lock (of the database pool, of
+    # stderr...) would wait for it forever. The tasks get a child of their own.
+    log.write_directly()
+    children: dict[int, str] = {}
+
+    def spawn(role: str) -> None:
+        pid = os.fork()
+        if pid == 0:
+            (_run_tasks_child if role == "tasks" else _serve_child)([sock])
+        children[pid] = role
+
+    def stop(*_) -> NoReturn:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        log.flush()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    log.info(f"Starting {workers} web workers on {Config.address}:{Config.port}")
+    for _ in range(workers):
+        spawn("web")
+    spawn("tasks")
+    while True:
+        pid, status = os.wait()
+        if (role := children.pop(pid, None)) is not None:
+            log.error(f"The {role} process {pid} died (status {status}), restarting it")
+            spawn(role)
 
 
 def main() -> None:
     with app.app_context():
+        if len(sys.argv) == 3 and sys.argv[1] == "--restore":
+            backup.restore(sys.argv[2])
+        elif len(sys.argv) > 1:
+            log.fatal(f"Usage: {sys.argv[0]} [--restore BACKUP]")
         db.create_all()
-    _worker.start()
-    serve(app, host=Config.address, port=Config.port)
+        migrate()
+    if _WEB_WORKERS > 1:
+        _serve_prefork(_WEB_WORKERS)
+    else:
+        _start_tasks()
+        serve(app, host=Config.address, port=Config.port, threads=admission.THREADS)
 
 
 if __name__ == "__main__":
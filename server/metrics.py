@@ -0,0 +1,155 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from threading import Lock, local
+from typing import Callable, Iterator
+
+
+# Every thread records into its own shard, so that the hot path never takes a lock
+# and never races with other threads. Shards are only summed up when scraped.
+
+type Labels = tuple[str, ...]
+type Samples = dict[Labels, float]
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_registry: list["Metric"] = []
+_registry_lock = Lock()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    _TYPE = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._local = local()
+        self._shards: list[dict] = []
+        with _registry_lock:
+            _registry.append(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with _registry_lock:
+                self._shards.append(shard)
+            return shard
+
+    @abstractmethod
+    def _samples(self) -> Iterator[str]:
+        pass
+
+    def expose(self) -> str:
+        header = (
+            f"# HELP {self.name} {self.description}\n# TYPE {self.name} {self._TYPE}\n"
+        )
+        return header + "".join(f"{x}\n" for x in self._samples())
+
+
+class Counter(Metric):
+    _TYPE = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        totals: Samples = {}
+        for shard in list(self._shards):
+            # dict.copy() is atomic, iterating over a dict that is being written is not
+            for labels, value in shard.copy().items():
+                totals[labels] = totals.get(labels, 0) + value
+        for labels, value in sorted(totals.items()):
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    _TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        if (entry := shard.get(labels)) is None:
+            # One counter per bucket, plus +Inf and the sum of the observed values
+            entry = shard[labels] = [0] * (len(self.buckets) + 2)
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def _samples(self) -> Iterator[str]:
+        totals: dict[Labels, list[float]] = {}
+        for shard in list(self._shards):
+            for labels, entry in shard.copy().items():
+                total = totals.setdefault(labels, [0] * len(entry))
+                for i, value in enumerate(list(entry)):
+                    total[i] += value
+        for labels, total in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], total):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+
+class Gauge(Metric):
+    """A value that is computed only when the metrics are scraped."""
+
+    _TYPE = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        collect: Callable[[], Samples],
+        labels: tuple[str, ...] = (),
+    ):
+        super().__init__(name, description, labels)
+        self.collect = collect
+
+    def _samples(self) -> Iterator[str]:
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+def expose() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    return "".join(metric.expose() for metric in metrics)
@@ -0,0 +1,132 @@
+import log
+import flags
+import metrics
+import requests
+
+from time import sleep
+from urllib.parse import urlsplit, unquote
+from flask import Flask
+from config import Config
+from timeutils import time
+
+
+PEERS: list[str] = list(Config.peers)
+NODE_ID = str(Config.node_id)
+_SUBMITTER = str(Config.submitter)
+_PERIOD = int(Config.replication_period)
+_TIMEOUT = int(Config.submit_timeout)
+# Maximum number of changes in every response of the changefeed
+CHANGES_LIMIT = 1000
+# Peers that could not be reached for this long are considered down
+_PEER_TIMEOUT = 3 * _PERIOD + _TIMEOUT
+
+
+class Peer(object):
+    def __init__(self, url: str):
+        # Keep the password out of the logs and of the metrics
+        parts = urlsplit(url.rstrip("/"))
+        self.url = parts._replace(netloc=parts.netloc.rpartition("@")[2]).geturl()
+        self.auth = (unquote(parts.username or ""), unquote(parts.password or ""))
+        self.node: str | None = None
+        self.epoch: str | None = None
+        self.cursor = 0
+        self.last_seen = 0
+
+
+_peers = [Peer(x) for x in PEERS]
+# Don't submit before knowing whether the peers are alive
+_ready = len(_peers) == 0
+
+_REPLICATED = metrics.Counter(
+    "farm_replicated_flags_total", "Flags changed by the changes of a peer", ("peer",)
+)
+_PULL_ERRORS = metrics.Counter(
+    "farm_replication_errors_total", "Failed pulls from a peer", ("peer",)
+)
+metrics.Gauge(
+    "farm_replication_last_seen_seconds",
+    "Time since the last successful pull from a peer",
+    lambda: {(x.url,): time() - x.last_seen for x in _peers},
+    ("peer",),
+)
+
+
+def _valid_record(record: object) -> bool:
+    return (
+        isinstance(record, list)
+        and len(record) == 7
+        and all(isinstance(x, str) for x in record[:2])
+        and isinstance(record[2], str | None)
+        and flags.valid_status(record[3])
+        and isinstance(record[4], int)
+        and isinstance(record[5], int | None)
+        and isinstance(record[6], str | None)
+    )
+
+
+def _pull(peer: Peer) -> None:
+    while True:
+        response = requests.get(
+            f"{peer.url}/api/replication/changes",
+            params={"since": peer.cursor, "limit": CHANGES_LIMIT},
+            auth=peer.auth,
+            timeout=_TIMEOUT,
+        )
+        response.raise_for_status()
+        data = response.json()
+        if data["epoch"] != peer.epoch:
+            # The peer numbered its changes again, so everything has to be pulled again
+            if peer.epoch is not None:
+                log.warning(f"Peer {peer.url} was reset, replicating it from scratch")
+            peer.epoch = data["epoch"]
+            peer.cursor = 0
+            continue
+        changes = data["changes"]
+        records = [x for _, x in changes if _valid_record(x)]
+        if len(records) < len(changes):
+            log.warning(
+                f"Ignored {len(changes) - len(records)} invalid flags from {peer.url}"
+            )
+        if (changed := flags.merge(records)) > 0:
+            log.info(f"Replicated {changed} flags from {peer.url}")
+            _REPLICATED.inc(peer.url, amount=changed)
+        if len(changes) > 0:
+            peer.cursor = changes[-1][0]
+        peer.node = data["node"]
+        peer.last_seen = time()
+        if len(changes) < CHANGES_LIMIT:
+            return
+
+
+def is_submitter() -> bool:
+    """Tells whether this farm should submit the flags to the game system. Unless
+    configured, the reachable farm with the lowest node ID is elected."""
+    if _SUBMITTER:
+        return _SUBMITTER == NODE_ID
+    if not _ready:
+        return False
+    now = time()
+    alive = [x.node for x in _peers if x.node and now - x.last_seen <= _PEER_TIMEOUT]
+    return all(NODE_ID < x for x in alive)
+
+
+def task(app: Flask) -> None:
+    global _ready
+
+    submitter = None
+    while True:
+        with app.app_context():
+            for peer in _peers:
+                try:
+                    _pull(peer)
+                except (requests.RequestException, KeyError, TypeError) as e:
+                    log.error(f"Could not replicate peer {peer.url}. {e}")
+                    _PULL_ERRORS.inc(peer.url)
+        _ready = True
+        if submitter != (submitter := is_submitter()):
+            log.info(
+                "This farm submits the flags"
+                if submitter
+                else "Another farm submits the flags"
+            )
+        sleep(_PERIOD)
@@ -1,3 +1,5 @@
+import secrets
+
 from flask import session
 from hashlib import sha256
 from config import Config
@@ -8,9 +10,15 @@ from timeutils import time
 SESSION_LIFETIME = 72 * 60 * 60
 
 
+def check_password(password: str) -> bool:
+    return sha256(password.encode()).digest() == Config.password
+
+
 def authenticate(password: str) -> bool:
-    if auth := sha256(password.encode()).digest() == Config.password:
+    if auth := check_password(password):
         session["expires"] = time() + SESSION_LIFETIME
+        # Tells the sessions apart for rate limiting
+        session.setdefault("id", secrets.token_hex(8))
     session["auth"] = auth
     return auth
 
@@ -1,4 +1,5 @@
 const flagsTable = document.getElementById("flags");
+const timingsTable = document.getElementById("timings");
 const nextPageBtn = document.getElementById("next-page");
 const prevPageBtn = document.getElementById("prev-page");
 const pageCounter = document.getElementById("page-counter");
@@ -85,6 +86,47 @@ async function refreshTables() {
     }
 }
 
+function formatSeconds(seconds) {
+    return seconds == null ? "-" : `${seconds.toFixed(2)}s`;
+}
+
+function buildTimingsTable(data) {
+    if (data.length === 0) {
+        return "<p> No exploit timings, run start_sploit.py with --profile to collect them </p>"
+    }
+    let html = "<table>"
+    html += buildTableHeader(["Exploit", "Team", "Runs", "Total", "Average", "Max", "First Flag", "Failures", "Output"]);
+    html += "<tbody>";
+    data.forEach(obj => {
+        entry  = `<td>${DOMPurify.sanitize(obj.exploit)}</td>`;
+        entry += `<td>${DOMPurify.sanitize(obj.team)}</td>`;
+        entry += `<td>${obj.runs}</td>`;
+        entry += `<td>${formatSeconds(obj.totalTime)}</td>`;
+        entry += `<td>${formatSeconds(obj.averageTime)}</td>`;
+        entry += `<td>${formatSeconds(obj.maxTime)}</td>`;
+        entry += `<td>${formatSeconds(obj.firstFlagTime)}</td>`;
+        entry += `<td>${obj.failures}</td>`;
+        entry += `<td>${obj.outputSize}</td>`;
+        html += `<tr>${entry}</tr>`;
+    });
+    html += "</tbody></table>";
+    return html;
+}
+
+async function refreshTimings() {
+    try {
+        const response = await fetch("/api/timings?count=10");
+        if (response.status === 200) {
+            timingsTable.innerHTML = buildTimingsTable(await response.json());
+        } else {
+            console.log("could not refresh timings table (server error)");
+        }
+    } catch (error) {
+        const type = getJsonFetchErrorType(error);
+        console.log(`could not refresh timings table (${type})`);
+    }
+}
+
 nextPageBtn.addEventListener("click", () => changePage(+1));
 prevPageBtn.addEventListener("click", () => changePage(-1));
 entriesCount.addEventListener("change", () => {
@@ -229,6 +271,7 @@ async function refreshSelector() {
 
 async function refreshAll() {
     await refreshTables();
+    await refreshTimings();
     await refreshSelector();
 }
 
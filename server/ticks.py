@@ -0,0 +1,17 @@
+from config import Config
+from timeutils import time
+
+
+TICK_DURATION = int(Config.tick_duration)
+
+# The start of the game, as a UNIX timestamp. When it's unknown ticks are simply
+# aligned to multiples of the tick duration.
+TICK_START = int(Config.tick_start)
+
+
+def current() -> int:
+    return (time() - TICK_START) // TICK_DURATION
+
+
+def start_of(tick: int) -> int:
+    return TICK_START + tick * TICK_DURATION
@@ -1,15 +1,44 @@
-from time import time as get_time
+from time import time as get_time, sleep as real_sleep
 from datetime import datetime
 
 _FMT = "%Y-%m-%d %H:%M:%S"
 
 
+class Clock(object):
+    """The clock of the server, the real one unless a game is being simulated."""
+
+    def time(self) -> float:
+        return get_time()
+
+    def sleep(self, seconds: float) -> None:
+        real_sleep(seconds)
+
+
+_clock = Clock()
+
+
+def use_clock(clock: Clock) -> None:
+    """Makes the whole server follow another clock, e.g. to replay a game faster than
+    real time."""
+    global _clock
+
+    _clock = clock
+
+
 def date() -> str:
-    return datetime.now().strftime(_FMT)
+    return datetime.fromtimestamp(_clock.time()).strftime(_FMT)
 
 
 def time() -> int:
-    return int(get_time())
+    return int(_clock.time())
+
+
+def precise_time() -> float:
+    return _clock.time()
+
+
+def sleep(seconds: float) -> None:
+    _clock.sleep(seconds)
 
 
 def time_to_date(timestamp: int) -> str:
@@ -0,0 +1,105 @@
+import ticks
+import metrics
+
+from config import Config
+from database import db, Timings
+from sqlalchemy import case
+
+
+# Only the recent runs matter, like the flags they could have stolen
+_KEEP_TICKS = int(Config.flag_lifetime)
+
+STATUSES = ("ok", "crash", "timeout", "error")
+
+type Timing = dict[str, str | int | float | None]
+type Report = dict[str, str | int | float | None]
+
+_RUN_TIME = metrics.Histogram(
+    "farm_exploit_run_seconds",
+    "Wall time of the runs of the exploits, as reported by the clients",
+    ("exploit",),
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100),
+)
+
+# The last tick in which the old timings were dropped by this process
+_cleaned = 0
+
+
+def valid_timing(timing: object) -> bool:
+    return (
+        isinstance(timing, dict)
+        and isinstance(timing.get("exploit"), str)
+        and isinstance(timing.get("team"), str)
+        and timing.get("status") in STATUSES
+        and isinstance(timing.get("wallTime"), int | float)
+        and isinstance(timing.get("firstFlagTime"), int | float | None)
+        and isinstance(timing.get("outputSize"), int)
+        and isinstance(timing.get("flags"), int)
+    )
+
+
+def record(runner: str, timings: list[Timing]) -> None:
+    global _cleaned
+
+    tick = ticks.current()
+    if len(timings) > 0:
+        db.session.execute(
+            db.insert(Timings),
+            [
+                {
+                    "tick": tick,
+                    "exploit": x["exploit"],
+                    "team": x["team"],
+                    "runner": runner,
+                    "status": x["status"],
+                    "wall_time": x["wallTime"],
+                    "first_flag_time": x["firstFlagTime"],
+                    "output_size": x["outputSize"],
+                    "flags": x["flags"],
+                }
+                for x in timings
+            ],
+        )
+    if _cleaned != tick:
+        db.session.execute(db.delete(Timings).where(Timings.tick < tick - _KEEP_TICKS))
+        _cleaned = tick
+    db.session.commit()
+    for timing in timings:
+        _RUN_TIME.observe(float(timing["wallTime"] or 0), str(timing["exploit"]))
+
+
+def report(count: int) -> list[Report]:
+    """Returns the exploit and team pairs that took the most runner time lately."""
+    total_time = db.func.sum(Timings.wall_time).label("total_time")
+    rows = db.session.execute(
+        db.select(
+            Timings.exploit,
+            Timings.team,
+            db.func.count().label("runs"),
+            total_time,
+            db.func.max(Timings.wall_time).label("max_time"),
+            db.func.avg(Timings.first_flag_time).label("first_flag_time"),
+            db.func.sum(case((Timings.status != "ok", 1), else_=0)).label("failures"),
+            db.func.avg(Timings.output_size).label("output_size"),
+            db.func.sum(Timings.flags).label("flags"),
+        )
+        .where(Timings.tick >= ticks.current() - _KEEP_TICKS)
+        .group_by(Timings.exploit, Timings.team)
+        .order_by(total_time.desc())
+        .limit(count)
+    )
+    return [
+        {
+            "exploit": x.exploit,
+            "team": x.team,
+            "runs": x.runs,
+            "totalTime": x.total_time,
+            "averageTime": x.total_time / x.runs,
+            "maxTime": x.max_time,
+            "firstFlagTime": x.first_flag_time,
+            "failures": x.failures,
+            "outputSize": round(x.output_size),
+            "flags": x.flags,
+        }
+        for x in rows
+    ]
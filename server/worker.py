@@ -1,12 +1,13 @@
 import log
 import flags
+import replication
+import metrics
 import requests
 
-from time import sleep
+from time import perf_counter
 from flask import Flask
 from config import Config
-from database import db, Flags
-from timeutils import time
+from timeutils import time, sleep
 from abc import ABC, abstractmethod
 
 
@@ -16,6 +17,18 @@ _SYSTEM_TYPE = str(Config.system_type)
 _SYSTEM_URL = str(Config.system_url)
 _TEAM_TOKEN = str(Config.team_token)
 
+_SUBMIT_LATENCY = metrics.Histogram(
+    "farm_submit_request_seconds", "Latency of the requests to the game system"
+)
+_SUBMIT_ERRORS = metrics.Counter(
+    "farm_submit_errors_total", "Failed requests to the game system", ("reason",)
+)
+_SUBMITTED = metrics.Counter(
+    "farm_submitted_flags_total",
+    "Flags sent to the game system, by resulting status",
+    ("status",),
+)
+
 
 class SubmitterResponse(object):
     def __init__(self, flag: str, status: int, message: str):
@@ -30,12 +43,14 @@ class Submitter(ABC):
         pass
 
     @abstractmethod
-    def _send(self, batch: list[Flags]) -> None:
+    def _send(self, batch: list[str]) -> list[SubmitterResponse]:
         pass
 
-    def send(self, batch: list[Flags]) -> None:
-        self._send(batch)
-        db.session.commit()
+    def send(self, batch: list[str]) -> None:
+        responses = self._send(batch)
+        flags.submit_results([(x.flag, x.status, x.message) for x in responses])
+        for response in responses:
+            _SUBMITTED.inc(flags.status_name(response.status))
 
 
 class SubmitterForcAD(Submitter):
@@ -53,49 +68,62 @@ class SubmitterForcAD(Submitter):
             "Game system is set to ForcAD, but the submitter does not use the HTTP protocol",
         )
 
-    def _parse_response(self, flags_map: dict[str, Flags], obj: dict[str, str]) -> None:
-        if (flag := obj.get("flag")) and (flags_entry := flags_map.get(flag)):
+    def _parse_response(
+        self, batch: set[str], obj: dict[str, str]
+    ) -> SubmitterResponse | None:
+        if (flag := obj.get("flag")) and flag in batch:
             status = obj.get("status", "UNKNOWN")
             status = self._STATUS_MAP.get(status, flags.STATUS_UNKNOWN)
             message = obj.get("msg", "Unknown message")
             message = message.split("] ", 1)[-1]
-            flags_entry.submit_result(status, message)
+            return SubmitterResponse(flag, status, message)
+        return None
 
-    def _do_send(self, batch: list[Flags]) -> None:
-        flags_map = {x.flag: x for x in batch}
+    def _do_send(self, batch: list[str]) -> list[SubmitterResponse]:
         # Send flags to server
-        response = requests.put(
-            _SYSTEM_URL,
-            headers={"X-Team-Token": _TEAM_TOKEN},
-            json=list(flags_map.keys()),
-            timeout=_SUBMIT_TIMEOUT,
-        )
+        start = perf_counter()
+        try:
+            response = requests.put(
+                _SYSTEM_URL,
+                headers={"X-Team-Token": _TEAM_TOKEN},
+                json=batch,
+                timeout=_SUBMIT_TIMEOUT,
+            )
+        finally:
+            _SUBMIT_LATENCY.observe(perf_counter() - start)
         response = response.json()
         # Ensure the response looks valid
         if not isinstance(response, list):
             raise TypeError(f"Expected list, got {type(response).__name__}")
         # Convert response objects to common format
-        for obj in response:
-            self._parse_response(flags_map, obj)
+        pending = set(batch)
+        return list(filter(None, (self._parse_response(pending, x) for x in response)))
 
-    def _send(self, batch: list[Flags]) -> None:
+    def _send(self, batch: list[str]) -> list[SubmitterResponse]:
         try:
-            self._do_send(batch)
+            return self._do_send(batch)
         # Invalid response format
         except TypeError as e:
             log.error(f"Invalid system response. {e}")
+            _SUBMIT_ERRORS.inc("invalid_response")
         # Invalid response JSON
         except requests.JSONDecodeError:
             log.error(f"Could not decode system response")
+            _SUBMIT_ERRORS.inc("invalid_json")
         # Connection errors
         except requests.Timeout:
             log.error(f"Request to game system timed out")
+            _SUBMIT_ERRORS.inc("timeout")
         except requests.ConnectionError:
             log.error(f"Could not connect to game system")
+            _SUBMIT_ERRORS.inc("connection")
         except (requests.HTTPError, requests.TooManyRedirects):
             log.error(f"An HTTP error occurred")
+            _SUBMIT_ERRORS.inc("http")
         except requests.RequestException:
             log.error(f"An error occurred while building the request")
+            _SUBMIT_ERRORS.inc("request")
+        return []
 
 
 _submitter = (
@@ -105,29 +133,41 @@ _submitter = (
 )
 
 
-def _do_submit() -> int:
-    batch = flags.next_batch()
-    if len(batch) > 0:
-        log.info(f"Submitting {len(batch)} flags to game system")
-        _submitter.send(batch)
-        # Find the time until the next expiration
-        next_expiration = flags.LIFETIME - (time() - batch[-1].timestamp)
-        return min(_SUBMIT_PERIOD, next_expiration)
-    else:
-        return _SUBMIT_PERIOD
+class Worker(object):
+    """Expires and submits the flags, one step at a time."""
+
+    def __init__(self, submitter: Submitter):
+        self.submitter = submitter
+        self.last_submission = 0
+
+    def _submit(self) -> int:
+        batch = flags.next_batch()
+        if len(batch) > 0:
+            log.info(f"Submitting {len(batch)} flags to game system")
+            self.submitter.send([flag for flag, _ in batch])
+            # Find the time until the next expiration
+            next_expiration = flags.LIFETIME - (time() - batch[-1][1])
+            return min(_SUBMIT_PERIOD, next_expiration)
+        else:
+            return _SUBMIT_PERIOD
+
+    def step(self) -> int:
+        """Runs one round of the worker, returning how long to wait for the next one."""
+        # Expire flags
+        flags.mark_expired()
+        # Submit next batch, unless another farm is doing it
+        if not replication.is_submitter():
+            return _SUBMIT_PERIOD
+        elif (now := time()) - self.last_submission >= _SUBMIT_PERIOD:
+            self.last_submission = now
+            return self._submit()
+        else:
+            return _SUBMIT_PERIOD - (now - self.last_submission)
 
 
 def task(app: Flask) -> None:
-    last_submission = 0
-    sleepy_time = 0
+    worker = Worker(_submitter)
     while True:
         with app.app_context():
-            # Expire flags
-            flags.mark_expired()
-            # Submit next batch
-            if (now := time()) - last_submission >= _SUBMIT_PERIOD:
-                last_submission = now
-                sleepy_time = _do_submit()
-            else:
-                sleepy_time = _SUBMIT_PERIOD - (now - last_submission)
+            sleepy_time = worker.step()
         sleep(sleepy_time)